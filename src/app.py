@@ -2,48 +2,286 @@ import json
 import os
 from datetime import datetime
 
-from db import db, Location, Feature, Post, User
-from flask import Flask, request, send_file
-from hashlib import pbkdf2_hmac
+from db import (
+    db, Location, Feature, Post, User, assoc_features_locations, assoc_posts_users_likes, engine_options,
+    insert_ignoring_duplicates, upgrade_schema
+)
+from flask import Blueprint, Flask, Response, request, send_file, stream_with_context
 from dotenv import load_dotenv
-
-from image import image_route
+from sqlalchemy import func, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, selectinload
+
+from passwords import hash_password, verify_password, needs_rehash, password_hashing
+from feature_index import feature_index
+from metrics import metrics_route
+from pagination import (
+    STREAM_BATCH_SIZE, parse_limit, parse_fields, parse_id_cursor, encode_cursor, decode_cursor, keyset_page, id_page
+)
+from queries import query_instrumentation
+from responses import compression, dumps, failure_response, success_response
+from replicas import REPLICA_PREFIX, reading_primary, replica_routing, replica_urls
+from response_cache import TABLES, cached, invalidate, response_cache, table_versions
+from spatial import location_index, parse_coordinates
+
+from image import image_config, image_route, detach_images, collect_blobs, add_image_urls, legacy_images_exist, reindex_images
 from weather import weather_route
 
 
-app = Flask(__name__)
 db_filename = "IthacaTraveller.db"
 
 load_dotenv()
-salting = os.environ.get("PASSWORD_SALT")
-iterations = int(os.environ.get("NUMBER_OF_ITERATIONS"))
-image_route(app)
-weather_route(app)
 
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///%s" % db_filename
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-app.config["SQLALCHEMY_ECHO"] = True
+# settings of each APP_ENV, production must never run the debugger or echo every statement
+CONFIGS = {
+    "development": {
+        "DEBUG": True,
+        # per-request query counts are sent as X-DB-* headers instead, see queries.py
+        "SQLALCHEMY_ECHO": os.environ.get("SQLALCHEMY_ECHO") == "1",
+        "UPGRADE_SCHEMA_ON_START": True
+    },
+    "production": {
+        "DEBUG": False,
+        "SQLALCHEMY_ECHO": False,
+        # done once before the gunicorn workers start, see gunicorn.conf.py
+        "UPGRADE_SCHEMA_ON_START": False
+    }
+}
+
+api = Blueprint("api", __name__)
+
+
+def configure(app, env = None):
+    """
+    Loads the settings of env, by default the APP_ENV environment variable
+    """
+    env = env or os.environ.get("APP_ENV", "development")
+    if env not in CONFIGS:
+        raise ValueError("unknown APP_ENV %s" % env)
+
+    app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL", "sqlite:///%s" % db_filename)
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app.config["SQLALCHEMY_DATABASE_URI"])
+    app.config["SQLALCHEMY_BINDS"] = {
+        "%s%d" % (REPLICA_PREFIX, n): dict(engine_options(url), url = url)
+        for n, url in enumerate(replica_urls())
+    }
+    # seconds a client reads from the primary after writing, longer than the replication lag
+    app.config["REPLICA_STICKY_SECONDS"] = int(os.environ.get("REPLICA_STICKY_SECONDS", 5))
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config.update(CONFIGS[env])
+
+
+def upgrade_database(env = None):
+    """
+    Creates the missing tables and upgrades the schema of the database
+    Moves the images still stored in the folders used before the blob store
+    into it, so they are served without running reindex-images
+    Must not run in several processes at once, so production servers run it
+    once before starting their workers
+    """
+    app = Flask(__name__)
+    configure(app, env)
+    image_config(app)
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        upgrade_schema()
+        if legacy_images_exist():
+            reindex_images()
+
+
+def create_app(env = None):
+    """
+    Creates the application with the settings of env, by default the APP_ENV
+    environment variable
+    """
+    app = Flask(__name__)
+    configure(app, env)
+    response_cache(app)
+    password_hashing(app)
+    image_config(app)
+
+    db.init_app(app)
+    with app.app_context():
+        if app.config["UPGRADE_SCHEMA_ON_START"]:
+            db.create_all()
+            upgrade_schema()
+            if legacy_images_exist():
+                reindex_images()
+        sync_location_index()
+        sync_feature_index()
+
+    metrics_route(app)
+    compression(app)
+    query_instrumentation(app)
+    replica_routing(app)
+    app.register_blueprint(api)
+    image_route(app)
+    weather_route(app)
+    return app
+
+#### INDEXES ####
+# The in-memory indexes remember the versions of the tables they were built
+# from, and are rebuilt before use once another write, possibly handled by
+# another worker or host, changed those tables. They are read from the primary,
+# which has every write counted in those versions, unlike a lagging replica.
+# Locations written by this worker are applied to the spatial index directly
+
+def sync_location_index():
+    """
+    Rebuilds the spatial index of the locations if they changed since it was built
+    """
+    version, = table_versions("location")
+    if location_index.version == version:
+        return
+
+    with location_index.rebuild_lock:
+        # another thread may have rebuilt it while this one waited
+        version, = table_versions("location")
+        if location_index.version != version:
+            with reading_primary():
+                location_index.rebuild(db.session.query(Location.id, Location.latitude, Location.longitude), version)
+
+def sync_feature_index():
+    """
+    Rebuilds the feature index if the features or their locations changed since it was built
+    """
+    if feature_index.version == table_versions("feature", "association_features_locations"):
+        return
+
+    with feature_index.rebuild_lock:
+        version = table_versions("feature", "association_features_locations")
+        if feature_index.version != version:
+            with reading_primary():
+                feature_index.rebuild(
+                    db.session.query(Feature.id, Feature.name),
+                    db.session.execute(select(assoc_features_locations.c.feature_id, assoc_features_locations.c.location_id)),
+                    version
+                )
+
+#### GENERALIZE RETURN ####
+def jsonable(value):
+    """
+    Formats a column value as the serializers do, dates and coordinates as strings
+    """
+    return value if value is None or isinstance(value, (int, str)) else str(value)
+
+def collection_response(name, query, id_column, options, serialize, columns, extras = None, ids = None):
+    """
+    Responds with {name: [...]}, the items of query ordered by id
+
+    Items are serialize(row) for rows loaded with the loader options, or only
+    the fields listed in the fields parameter, taken from columns, a dict of
+    field name to column, which then are the only columns selected. extras
+    maps the name of a computed field to a function setting it on a list of
+    items, computed fields are always set unless fields are listed
 
-db.init_app(app)
-with app.app_context():
-    db.create_all()
+    With a limit or a cursor, one page is returned with the cursor of the
+    next one. Otherwise the whole collection is streamed, read STREAM_BATCH_SIZE
+    rows at a time, each batch in its own transaction, so memory does not grow
+    with the table nor does a slow client hold a connection for the whole body
+    ids optionally restricts the items to those ids, sorted increasingly
+    """
+    extras = extras or {}
+    try:
+        limit = parse_limit(request.args.get("limit"))
+        after = parse_id_cursor(request.args.get("cursor"))
+        fields = parse_fields(request.args.get("fields"), list(columns) + list(extras))
+    except ValueError:
+        return failure_response("invalid pagination parameters", 400)
 
-#### HELPER METHODS ####
-def hash_password(password):
-    secret_password = pbkdf2_hmac('sha384', password.encode(), salting.encode(), iterations)
-    return secret_password
+    if fields is None:
+        query = query.options(*options)
+    else:
+        selected = [columns[field].label(field) for field in fields if field in columns and field != "id"]
+        query = query.with_entities(id_column.label("id"), *selected)
 
+    def to_items(rows):
+        if fields is None:
+            items = [serialize(row) for row in rows]
+            for add_field in extras.values():
+                add_field(items)
+            return items
 
-#### GENERALIZE RETURN ####
-def success_response(body, code = 200):
-    return json.dumps(body), code
+        # the id is needed by extras even when it was not asked for
+        items = [{field: jsonable(value) for field, value in row._mapping.items()} for row in rows]
+        for field in fields:
+            if field in extras:
+                extras[field](items)
+        if "id" not in fields:
+            for item in items:
+                del item["id"]
+        return items
+
+    if "limit" in request.args or "cursor" in request.args:
+        rows, has_more = id_page(query, id_column, after, limit, ids)
+        next_cursor = encode_cursor(rows[-1].id) if has_more else None
+        return success_response({name: to_items(rows), "next_cursor": next_cursor})
+
+    def stream():
+        yield b'{"%s":[' % name.encode()
+        after = None
+        separator = b""
+        while True:
+            rows, has_more = id_page(query, id_column, after, STREAM_BATCH_SIZE, ids)
+            batch = b",".join(dumps(item) for item in to_items(rows))
+            after = rows[-1].id if rows else None
+            # returns the connection to the pool while the client reads the batch
+            db.session.rollback()
+            if rows:
+                yield separator + batch
+                separator = b","
+            if not has_more:
+                break
+        yield b"]}"
+
+    return Response(stream_with_context(stream()), mimetype = "application/json")
+
+
+
+#### USER POSTS ####
+
+def authored_posts(user_id):
+    """
+    Query of the posts written by a user
+    """
+    return Post.query.filter(Post.user_id == user_id)
+
+def liked_posts(user_id):
+    """
+    Query of the posts liked by a user
+    """
+    return Post.query.join(assoc_posts_users_likes, assoc_posts_users_likes.c.post_id == Post.id) \
+        .filter(assoc_posts_users_likes.c.user_id == user_id)
+
+def user_posts_page(query, after, limit):
+    """
+    Returns one page of the posts of query, newest first, and the cursor of the next page
+    Posts carry their like_count but not their liked users, whose number is unbounded,
+    and are loaded in a constant number of queries
+    """
+    rows, has_more = id_page(query.options(joinedload(Post.user)), Post.id, after, limit, descending = True)
+    posts = add_image_urls("post", [post.simple_serialize() for post in rows])
+    return posts, encode_cursor(rows[-1].id) if has_more else None
+
+def user_posts_response(user_id, query):
+    """
+    Responds with one page of the posts of query, which belong to or were liked by user_id
+    """
+    try:
+        limit = parse_limit(request.args.get("limit"))
+        after = parse_id_cursor(request.args.get("cursor"))
+    except ValueError:
+        return failure_response("invalid pagination parameters", 400)
 
-def failure_response(message, code = 404):
-    return json.dumps({"error": message}), code
+    if db.session.query(User.id).filter_by(id = user_id).first() is None:
+        return failure_response("user not found")
 
+    posts, next_cursor = user_posts_page(query, after, limit)
+    return success_response({"posts": posts, "next_cursor": next_cursor})
 
 
-@app.route("/")
+@api.route("/")
 def front_page():
     return "Hello! :D"
 
@@ -52,16 +290,20 @@ def front_page():
 
 #--------- Feature Routes ------------
 
-@app.route("/api/features/")
+@api.route("/api/features/")
+@cached("feature", "association_features_locations")
 def get_all_features():
     """
     Endpoint for getting all the features
+    Paginated with limit and cursor, fields selects the returned fields
     """
 
-    features = [feature.serialize() for feature in Feature.query.all()]
-    return success_response({"features": features})
+    return collection_response(
+        "features", Feature.query, Feature.id, [selectinload(Feature.locations)], Feature.serialize,
+        {"id": Feature.id, "name": Feature.name}
+    )
 
-@app.route("/api/features/<int:feature_id>/")
+@api.route("/api/features/<int:feature_id>/")
 def get_feature_by_id(feature_id):
     """
     Endpoint for getting feature by id
@@ -74,7 +316,7 @@ def get_feature_by_id(feature_id):
     
     return success_response(feature.serialize())
 
-@app.route("/api/features/", methods=["POST"])
+@api.route("/api/features/", methods=["POST"])
 def add_feature():
     """
     Enpoint for adding feature
@@ -94,11 +336,16 @@ def add_feature():
     feature = Feature(name = name)
 
     db.session.add(feature)
-    db.session.commit()
+    try:
+        invalidate("feature")
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return failure_response("feature already exists", 400)
 
     return success_response({}, 201)
 
-@app.route("/api/features/<int:feature_id>/", methods = ["POST"])
+@api.route("/api/features/<int:feature_id>/", methods = ["POST"])
 def update_feature(feature_id):
     """
     Endpoint for updating feature given id
@@ -117,13 +364,18 @@ def update_feature(feature_id):
     
     feature.name = name
 
-    db.session.commit()
+    try:
+        invalidate("feature")
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return failure_response("feature already exists", 400)
     feature = Feature.query.filter_by(id = feature_id).first()
     
     return success_response({})
     
 
-@app.route("/api/features/<int:feature_id>/locations/<int:location_id>/", methods = ["POST"])
+@api.route("/api/features/<int:feature_id>/locations/<int:location_id>/", methods = ["POST"])
 def add_feature_to_location(location_id, feature_id):
     """
     Endpoint adding feature tag to the location
@@ -143,13 +395,14 @@ def add_feature_to_location(location_id, feature_id):
 
     location.features.append(feature)
 
+    invalidate("association_features_locations")
     db.session.commit()
 
     location = Location.query.filter_by(id=location_id).first()
 
     return success_response({}, 401)
 
-@app.route("/api/features/<int:feature_id>/", methods = ["DELETE"])
+@api.route("/api/features/<int:feature_id>/", methods = ["DELETE"])
 def delete_feature_by_id(feature_id):
     """
     Endpoint for deleting a feature by its id
@@ -161,38 +414,103 @@ def delete_feature_by_id(feature_id):
         return failure_response("feature not found", 404)
 
     db.session.delete(feature)
+    invalidate("feature", "association_features_locations")
     db.session.commit()
     return success_response({})
 
 
 #--------- Location Routes ------------
 
-@app.route("/api/locations/")
+@api.route("/api/locations/")
+@cached(*TABLES)
 def get_all_locations():
     """
     Endpoint for getting all the locations
+    Optionally only those having the features listed in features, separated
+    by commas, either all of them (match=all, the default) or any (match=any)
+    Paginated with limit and cursor, fields selects the returned fields
     """
 
-    locations = [location.simple_serialize() for location in Location.query.all()]
-    return success_response({"locations": locations})
+    names = request.args.get("features")
+    match = request.args.get("match", "all")
+
+    if match != "all" and match != "any":
+        return failure_response("invalid match", 400)
+
+    ids = None
+    if names is not None:
+        sync_feature_index()
+        ids = feature_index.match([name for name in names.split(",") if name], match == "all")
+
+    columns = {
+        column: getattr(Location, column)
+        for column in ("id", "longitude", "latitude", "name", "address", "description")
+    }
+    return collection_response(
+        "locations", Location.query, Location.id, [selectinload(Location.features)],
+        Location.simple_serialize, columns, ids = ids
+    )
+
+
+@api.route("/api/locations/nearby/")
+def get_nearby_locations():
+    """
+    Endpoint for getting the locations closest to a position, nearest first
+    Requires lat and lon, optionally a radius in meters and a limit
+    """
+
+    lat = request.args.get("lat")
+    lon = request.args.get("lon")
+    radius = request.args.get("radius", default = None, type = float)
+
+    if lat is None or lon is None:
+        return failure_response("missing parameter", 400)
+
+    try:
+        lat, lon = parse_coordinates(lat, lon)
+    except ValueError:
+        return failure_response("invalid coordinates", 400)
+
+    try:
+        limit = parse_limit(request.args.get("limit"))
+    except ValueError:
+        return failure_response("invalid limit", 400)
+
+    sync_location_index()
+    nearest = location_index.nearby(lat, lon, radius, limit)
+    ids = [location_id for _, location_id in nearest]
+    locations = {
+        location.id: location
+        for location in Location.query.options(selectinload(Location.features)).filter(Location.id.in_(ids))
+    }
+
+    res = []
+    for distance, location_id in nearest:
+        location = locations.get(location_id)
+        if location is not None:
+            res.append(dict(location.simple_serialize(), distance = distance))
+
+    return success_response({"locations": res})
 
 
-@app.route("/api/locations/features/<feature>/")
+@api.route("/api/locations/features/<feature>/")
+@cached("feature", "association_features_locations")
 def get_locations_id_by_feature(feature):
     """
     Endpoint for getting locations id assoicated with feature by feature name
     """
 
-    feature = Feature.query.filter_by(name=feature).first()
-    if feature is None:
+    sync_feature_index()
+    if feature not in feature_index:
         return failure_response("feature not found", 404)
-    
-    locations = feature.serialize().get("locations")
+
+    locations = feature_index.match([feature])
     res = {"id":locations}
     return success_response([res])
 
 
-@app.route("/api/locations/<int:location_id>/")
+@api.route("/api/locations/<int:location_id>/")
+@cached(*TABLES)
 def get_location_by_id(location_id):
     """
     Endpoint for getting location details by its id
@@ -206,7 +524,7 @@ def get_location_by_id(location_id):
     return success_response(location.simple_serialize())
 
 
-@app.route("/api/locations/", methods=["POST"])
+@api.route("/api/locations/", methods=["POST"])
 def add_location():
     """
     Enpoint for adding location
@@ -222,6 +540,11 @@ def add_location():
         return failure_response("missing parameter", 400)
 
 
+    try:
+        lati, long = parse_coordinates(lati, long)
+    except ValueError:
+        return failure_response("invalid coordinates", 400)
+
     description = body.get("description")
     location = Location(
         longitude = long,
@@ -232,11 +555,13 @@ def add_location():
     )
     
     db.session.add(location)
+    version, = invalidate("location")
     db.session.commit()
+    location_index.upsert(location.id, lati, long, version)
     
     return success_response({}, 201)
 
-@app.route("/api/locations/<int:location_id>/", methods = ["POST"])
+@api.route("/api/locations/<int:location_id>/", methods = ["POST"])
 def update_location(location_id):
     """
     Endpoint for updating location given id
@@ -252,18 +577,24 @@ def update_location(location_id):
     lati = body.get("latitude", location.latitude)
     name = body.get("name", location.name)
     address = body.get("name", location.name)
+
+    try:
+        lati, long = parse_coordinates(lati, long)
+    except ValueError:
+        return failure_response("invalid coordinates", 400)
     
     location.longitude = long
     location.latitude = lati
     location.name = name
     location.address = address
 
+    version, = invalidate("location")
     db.session.commit()
-    location = Location.query.filter_by(id = location_id).first()
+    location_index.upsert(location_id, lati, long, version)
     
     return success_response({})
 
-@app.route("/api/locations/<int:location_id>/", methods = ["DELETE"])
+@api.route("/api/locations/<int:location_id>/", methods = ["DELETE"])
 def delete_location_by_id(location_id):
     """
     Endpoint for deleting a location by its id
@@ -274,36 +605,48 @@ def delete_location_by_id(location_id):
     if location is None:
         return failure_response("location not found", 404)
 
+    post_ids = [post_id for post_id, in db.session.query(Post.id).filter_by(location_id = location_id)]
+    released = detach_images("post", post_ids)
     db.session.delete(location)
+    version, _ = invalidate("location", "association_features_locations")
     db.session.commit()
+    collect_blobs(released)
+    location_index.remove(location_id, version)
     return success_response({})
 
 
 #--------- Posts Routes ------------
 
-@app.route("/api/posts/")
+@api.route("/api/posts/")
 def get_all_posts():
     """
     Endpoint for getting all posts
+    Paginated with limit and cursor, fields selects the returned fields
     """
 
-    posts = [post.serialize() for post in Post.query.all()]
-    return success_response({"posts": posts})
+    columns = {
+        column: getattr(Post, column)
+        for column in ("id", "timestamp", "comment", "location_id", "user_id", "like_count")
+    }
+    return collection_response(
+        "posts", Post.query, Post.id, Post.serialize_options(), Post.serialize, columns,
+        extras = {"image_url": lambda posts: add_image_urls("post", posts)}
+    )
 
-@app.route("/api/posts/<int:post_id>/")
+@api.route("/api/posts/<int:post_id>/")
 def get_post_by_id(post_id):
     """
     Endpoint for getting post by id
     """
 
-    post = Post.query.filter_by(id=post_id).first()
+    post = Post.query.options(*Post.serialize_options()).filter_by(id=post_id).first()
 
     if post is None:
         return failure_response("feature not found")
     
     return success_response(post.serialize())
 
-@app.route("/api/posts/", methods=["POST"])
+@api.route("/api/posts/", methods=["POST"])
 def add_post():
     """
     Enpoint for adding post
@@ -339,7 +682,7 @@ def add_post():
     
     return success_response({"post_id":post.id}, 201)
 
-@app.route("/api/posts/<int:post_id>/", methods = ["POST"])
+@api.route("/api/posts/<int:post_id>/", methods = ["POST"])
 def update_post(post_id):
     """
     Endpoint for updating a post
@@ -362,7 +705,7 @@ def update_post(post_id):
     return success_response({})
 
 
-@app.route("/api/posts/<int:post_id>/like/", methods = ["POST"])
+@api.route("/api/posts/<int:post_id>/like/", methods = ["POST"])
 def like_post(post_id):
     """
     Endpoint for liking a post
@@ -380,33 +723,67 @@ def like_post(post_id):
 
     if user is None:
         return failure_response("User not found")
-    
-    if user not in post.liked_users:
-        post.liked_users.append(user)
+
+    liked = db.session.execute(
+        select(assoc_posts_users_likes.c.post_id).where(
+            assoc_posts_users_likes.c.user_id == user.id,
+            assoc_posts_users_likes.c.post_id == post.id
+        )
+    ).first()
+
+    if liked is None:
+        result = db.session.execute(
+            insert_ignoring_duplicates(assoc_posts_users_likes).values(user_id = user.id, post_id = post.id)
+        )
+        change = 1
     else:
-        post.liked_users.remove(user)
-        
+        result = db.session.execute(
+            assoc_posts_users_likes.delete().where(
+                assoc_posts_users_likes.c.user_id == user.id,
+                assoc_posts_users_likes.c.post_id == post.id
+            )
+        )
+        change = -1
+
+    # a concurrent toggle may have added or removed the same like first, the count then already includes it
+    if result.rowcount == 1:
+        db.session.execute(
+            update(Post).where(Post.id == post.id).values(like_count = Post.like_count + change),
+            execution_options = {"synchronize_session": False}
+        )
     db.session.commit()
-    post = Post.query.filter_by(id = post_id).first()
+
     return success_response({})
 
 
-@app.route("/api/posts/locations/<int:location_id>/")
+@api.route("/api/posts/locations/<int:location_id>/")
 def get_posts_by_location(location_id):
     """
     Endpoint for getting posts under specific location by id
     Requires user id
+    Sorting and pagination are done by the database, one page is returned
+    together with the cursor of the next page
     """
 
     sort = request.args.get("sort")
     user_id = request.args.get("user_id")
 
     if sort != "recent" and sort != "likes":
-        return json.dumps({"error": "missing sorting method"}), 400
+        return failure_response("missing sorting method", 400)
 
     if user_id is None:
         return failure_response("missing user_id", 400)
 
+    try:
+        limit = parse_limit(request.args.get("limit"))
+        cursor = decode_cursor(request.args.get("cursor"))
+        if cursor is not None and sort == "recent":
+            cursor = [datetime.fromisoformat(cursor[0]), int(cursor[1])]
+        elif cursor is not None:
+            cursor = [int(cursor[0]), int(cursor[1])]
+    except (ValueError, TypeError, IndexError):
+        return failure_response("invalid pagination parameters", 400)
+
     user_id = int(request.args.get("user_id"))
 
     location = Location.query.filter_by(id=location_id).first()
@@ -418,16 +795,23 @@ def get_posts_by_location(location_id):
 
     if user is None:
         return failure_response("user not found", 404)
-    
-    if sort == "likes":
-        posts = sorted([post.checked_serialize(user_id) for post in location.posts], key = lambda post:len(post.get("liked_users")), reverse = True)
-    else:
-        posts = sorted([post.checked_serialize(user_id) for post in location.posts], key = lambda post:(post.get("timestamp")), reverse = True)
 
-    return success_response({"posts": posts})
+    key = Post.like_count if sort == "likes" else Post.timestamp
+    query = db.session.query(Post, key)
+
+    query = query.options(*Post.serialize_options()).filter(Post.location_id == location_id)
+    rows, has_more = keyset_page(query, key, Post.id, cursor, limit)
+
+    posts = add_image_urls("post", [post.checked_serialize(user_id) for post, _ in rows])
+    next_cursor = None
+    if has_more:
+        last_post, last_key = rows[-1]
+        next_cursor = encode_cursor(last_key, last_post.id)
 
+    return success_response({"posts": posts, "next_cursor": next_cursor})
 
-@app.route("/api/posts/<int:post_id>/", methods = ["DELETE"])
+
+@api.route("/api/posts/<int:post_id>/", methods = ["DELETE"])
 def delete_post_by_id(post_id):
     """
     Endpoint for deleting a post by its id
@@ -438,23 +822,27 @@ def delete_post_by_id(post_id):
     if post is None:
         return failure_response("post not found", 404)
 
+    released = detach_images("post", [post_id])
     db.session.delete(post)
     db.session.commit()
+    collect_blobs(released)
     return success_response({})
 
 
 #--------- Users Routes ------------
-@app.route("/api/users/")
+@api.route("/api/users/")
 def get_all_users():
     """
     Endpoint for getting all users
+    Paginated with limit and cursor, fields selects the returned fields
     """
 
-    users = [user.simple_serialize() for user in User.query.all()]
-    return success_response({"users": users})
+    return collection_response(
+        "users", User.query, User.id, [], User.simple_serialize, {"id": User.id, "username": User.username}
+    )
 
 
-@app.route("/api/users/", methods = ["POST"])
+@api.route("/api/users/", methods = ["POST"])
 def add_user():
     """
     Endpoint for adding users
@@ -467,34 +855,80 @@ def add_user():
     if username is None or password is None:
         return failure_response("missing parameter", 400)
 
-    hashed_password = hash_password(password)
-
     user = User.query.filter_by(username = username).first()
 
     if user is not None:
         return failure_response("user already exist", 400)
 
+    hashed_password = hash_password(password)
+
     user = User(username = username,
                 password = hashed_password
                 )
     
     db.session.add(user)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return failure_response("user already exist", 400)
 
     return success_response({"user_id": user.id}, 201)
 
-@app.route("/api/users/<int:user_id>/")
+@api.route("/api/users/<int:user_id>/")
 def get_user_by_id(user_id):
     """
     Endpoint for getting user by id
+    Returns the number of posts written and liked by the user, and the first
+    page of each, newest first, in a number of queries independent of their count
     """
+    try:
+        limit = parse_limit(request.args.get("limit"))
+    except ValueError:
+        return failure_response("invalid limit", 400)
+
     user = User.query.filter_by(id = user_id).first()
     if user is None:
         return failure_response("user not found")
-    
-    return success_response(user.serialize())
 
-@app.route("/api/users/<int:user_id>/", methods = ["DELETE"])
+    post_count, liked_count = db.session.execute(select(
+        select(func.count()).select_from(Post).where(Post.user_id == user_id).scalar_subquery(),
+        select(func.count()).select_from(assoc_posts_users_likes)
+            .where(assoc_posts_users_likes.c.user_id == user_id).scalar_subquery()
+    )).one()
+
+    posts, posts_cursor = user_posts_page(authored_posts(user_id), None, limit)
+    liked, liked_cursor = user_posts_page(liked_posts(user_id), None, limit)
+
+    res = user.simple_serialize()
+    add_image_urls("user", [res])
+    res.update({
+        "post_count": post_count,
+        "post_liked_count": liked_count,
+        "posts": posts,
+        "posts_next_cursor": posts_cursor,
+        "post_liked": liked,
+        "post_liked_next_cursor": liked_cursor
+    })
+    return success_response(res)
+
+@api.route("/api/users/<int:user_id>/posts/")
+def get_user_posts(user_id):
+    """
+    Endpoint for getting the posts written by a user, newest first
+    Paginated with limit and cursor
+    """
+    return user_posts_response(user_id, authored_posts(user_id))
+
+@api.route("/api/users/<int:user_id>/likes/")
+def get_user_likes(user_id):
+    """
+    Endpoint for getting the posts liked by a user, most recently written first
+    Paginated with limit and cursor
+    """
+    return user_posts_response(user_id, liked_posts(user_id))
+
+@api.route("/api/users/<int:user_id>/", methods = ["DELETE"])
 def delete_user_by_id(user_id):
     """
     Endpoint for deleting an user by its id
@@ -505,12 +939,21 @@ def delete_user_by_id(user_id):
     if user is None:
         return failure_response("user not found", 404)
 
+    db.session.execute(
+        update(Post).where(
+            Post.id.in_(select(assoc_posts_users_likes.c.post_id).where(assoc_posts_users_likes.c.user_id == user_id))
+        ).values(like_count = Post.like_count - 1),
+        execution_options = {"synchronize_session": False}
+    )
+    post_ids = [post_id for post_id, in db.session.query(Post.id).filter_by(user_id = user_id)]
+    released = detach_images("user", [user_id]) + detach_images("post", post_ids)
     db.session.delete(user)
     db.session.commit()
+    collect_blobs(released)
     return success_response({})
 
 
-@app.route("/api/users/verify/", methods = ["POST"])
+@api.route("/api/users/verify/", methods = ["POST"])
 def verify_user():
     """
     Endpoint for verifying whether password is correct
@@ -527,15 +970,17 @@ def verify_user():
     if user is None:
         return failure_response("user not found", 404)
     
-    hashed_password = hash_password(password)
-    
     #check with frontend for return message format
     
 
-    if user.password == hashed_password:
+    if verify_password(password, user.password):
+        if needs_rehash(user.password):
+            user.password = hash_password(password)
+            db.session.commit()
+
         res = {
             "verify":True,
-            "user_id": user.serialize().get("id")
+            "user_id": user.id
             }
         return success_response(res)
     else:
@@ -544,4 +989,5 @@ def verify_user():
 
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=8000, debug=True)
+    app = create_app()
+    app.run(host="0.0.0.0", port=8000, debug=app.config["DEBUG"])
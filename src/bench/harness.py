@@ -0,0 +1,105 @@
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+
+# the app directory, where the servers are started from
+SRC = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# command of each server mode, run from SRC
+SERVERS = {
+    "dev": [sys.executable, "app.py"],
+    "production": [sys.executable, "-m", "gunicorn", "--config", "gunicorn.conf.py", "wsgi:app"]
+}
+
+
+@contextmanager
+def serve(mode, env, port = 8000, timeout = 60):
+    """
+    Runs the server of the given mode with the extra environment variables in
+    env, and yields its base url once it answers. The dev server always
+    listens on port 8000
+    """
+    env = dict(os.environ, GUNICORN_BIND = "127.0.0.1:%d" % port, **env)
+    # a process group, so that the dev reloader and the gunicorn workers are stopped too
+    process = subprocess.Popen(
+        SERVERS[mode], cwd = SRC, env = env, start_new_session = True,
+        stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL
+    )
+    base = "http://127.0.0.1:%d" % port
+    try:
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                requests.get(base + "/api/features/?limit=1", timeout = 5)
+                break
+            except requests.RequestException:
+                if process.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError("%s server did not start" % mode)
+                time.sleep(0.2)
+        yield base
+    finally:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait()
+
+
+def run_load(send, concurrency, total):
+    """
+    Calls send(session, n) total times from concurrency threads, each with its
+    own keep-alive session, send returning whether the call succeeded
+    Returns the throughput and latency percentiles of the calls
+    """
+    latencies = []
+    errors = [0]
+    counter = iter(range(total))
+    lock = threading.Lock()
+
+    def worker():
+        session = requests.Session()
+        while True:
+            with lock:
+                n = next(counter, None)
+            if n is None:
+                return
+            start = time.perf_counter()
+            try:
+                ok = send(session, n)
+            except requests.RequestException:
+                ok = False
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                errors[0] += not ok
+
+    threads = [threading.Thread(target = worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests": total,
+        "seconds": seconds,
+        "rps": total / seconds,
+        "p50_ms": 1000 * latencies[len(latencies) // 2],
+        "p99_ms": 1000 * latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)],
+        "errors": errors[0]
+    }
+
+
+def print_table(header, rows):
+    """
+    Prints rows, lists of values, aligned under header
+    """
+    rows = [[("%.1f" % value) if isinstance(value, float) else str(value) for value in row] for row in rows]
+    widths = [max(len(str(cell)) for cell in column) for column in zip(header, *rows)]
+    for row in [header] + rows:
+        print("  ".join(str(cell).rjust(width) for cell, width in zip(row, widths)))
@@ -0,0 +1,95 @@
+"""
+Load test comparing the requests per second of the development server and
+of the production gunicorn server, on the same seeded database
+
+Run from src/, with gunicorn installed and nothing listening on port 8000:
+
+    python -m bench.load --concurrency 1,8,32 --requests 2000
+
+The clients are threads of this process, on the same machine as the server,
+so compare the modes on a host with several cores, or point --url at a server
+started elsewhere
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+
+import requests
+
+from bench.harness import print_table, run_load, serve
+
+# read endpoints hit by the load, each request picks one at random
+PATHS = [
+    "/api/locations/",
+    "/api/locations/%(location)d/",
+    "/api/locations/nearby/?lat=42.44&lon=-76.50&radius=5000",
+    "/api/posts/?limit=20",
+    "/api/posts/locations/%(location)d/?sort=recent&limit=20&user_id=%(user)d",
+    "/api/users/%(user)d/"
+]
+
+
+def seed(base, locations, users, posts):
+    """
+    Fills the database through the api, unless it already has locations
+    """
+    session = requests.Session()
+    if json.loads(session.get(base + "/api/locations/?limit=1").content)["locations"]:
+        return
+    for n in range(locations):
+        session.post(base + "/api/locations/", data = json.dumps({
+            "name": "location %d" % n, "address": "address %d" % n, "description": "",
+            "latitude": 42.44 + random.uniform(-0.05, 0.05), "longitude": -76.50 + random.uniform(-0.05, 0.05)
+        }))
+    for n in range(users):
+        session.post(base + "/api/users/", data = json.dumps({"username": "user%d" % n, "password": "password"}))
+    for n in range(posts):
+        session.post(base + "/api/posts/", data = json.dumps({
+            "comment": "comment %d" % n, "location_id": random.randint(1, locations), "user_id": random.randint(1, users)
+        }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", default = "dev,production", help = "servers to compare, comma separated")
+    parser.add_argument("--concurrency", default = "1,8,32", help = "concurrent clients, comma separated")
+    parser.add_argument("--requests", type = int, default = 2000, help = "requests per run")
+    parser.add_argument("--locations", type = int, default = 200)
+    parser.add_argument("--users", type = int, default = 20)
+    parser.add_argument("--posts", type = int, default = 2000)
+    parser.add_argument("--url", help = "load a server already running at this url instead, seeded if it has no locations")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        # both servers share one scratch database, instead of instance/IthacaTraveller.db
+        env = {
+            "DATABASE_URL": "sqlite:///" + os.path.join(folder, "bench.db"),
+            "WEATHER_PREFETCH_INTERVAL": "0"
+        }
+
+        def send(session, n):
+            path = random.choice(PATHS) % {"location": random.randint(1, args.locations), "user": random.randint(1, args.users)}
+            return session.get(base + path).status_code == 200
+
+        def measure(mode):
+            seed(base, args.locations, args.users, args.posts)
+            for concurrency in map(int, args.concurrency.split(",")):
+                result = run_load(send, concurrency, args.requests)
+                rows.append([mode, concurrency, result["rps"], result["p50_ms"], result["p99_ms"], result["errors"]])
+
+        rows = []
+        if args.url:
+            base = args.url.rstrip("/")
+            measure(base)
+        else:
+            for mode in args.modes.split(","):
+                with serve(mode, env) as base:
+                    measure(mode)
+
+    print_table(["server", "clients", "req/s", "p50 ms", "p99 ms", "errors"], rows)
+
+
+if __name__ == "__main__":
+    main()
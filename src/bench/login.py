@@ -0,0 +1,74 @@
+"""
+Login throughput of the production server at several concurrency levels
+
+Sends POST /api/users/verify/ with the right password from concurrent
+clients, each login costing one scrypt hash, run in the request thread
+within one of the PASSWORD_HASH_WORKERS slots of the host. Meanwhile a
+probe requests a cheap endpoint, to show whether logins starve the other
+requests. Run from src/, with gunicorn installed and nothing listening on
+port 8000:
+
+    python -m bench.login --concurrency 1,2,4,8,16,32 --hash-workers 1,4
+"""
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+
+import requests
+
+from bench.harness import print_table, run_load, serve
+
+USER = {"username": "bench", "password": "correct horse battery staple"}
+
+
+def probe(base, stop):
+    """
+    Requests a cheap endpoint until stop is set, returns its median latency in ms
+    """
+    session = requests.Session()
+    latencies = []
+    while not stop.is_set():
+        start = time.perf_counter()
+        session.get(base + "/api/features/?limit=1")
+        latencies.append(time.perf_counter() - start)
+        time.sleep(0.01)
+    latencies.sort()
+    return 1000 * latencies[len(latencies) // 2] if latencies else float("nan")
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", default = "1,2,4,8,16,32", help = "concurrent clients, comma separated")
+    parser.add_argument("--hash-workers", default = str(os.cpu_count() or 1), help = "PASSWORD_HASH_WORKERS values to compare, comma separated")
+    parser.add_argument("--requests", type = int, default = 200, help = "logins per run")
+    args = parser.parse_args()
+
+    def send(session, n):
+        return session.post(base + "/api/users/verify/", data = json.dumps(USER)).status_code == 200
+
+    rows = []
+    with tempfile.TemporaryDirectory() as folder:
+        env = {"DATABASE_URL": "sqlite:///" + os.path.join(folder, "bench.db"), "WEATHER_PREFETCH_INTERVAL": "0"}
+        for hash_workers in args.hash_workers.split(","):
+            with serve("production", dict(env, PASSWORD_HASH_WORKERS = hash_workers)) as base:
+                requests.post(base + "/api/users/", data = json.dumps(USER))
+                for concurrency in map(int, args.concurrency.split(",")):
+                    stop = threading.Event()
+                    probed = []
+                    prober = threading.Thread(target = lambda: probed.append(probe(base, stop)))
+                    prober.start()
+                    result = run_load(send, concurrency, args.requests)
+                    stop.set()
+                    prober.join()
+                    rows.append([
+                        hash_workers, concurrency, result["rps"], result["p50_ms"], result["p99_ms"], probed[0], result["errors"]
+                    ])
+
+    print_table(["hash slots", "clients", "logins/s", "p50 ms", "p99 ms", "probe ms", "errors"], rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+"""
+Scaling benchmark of the login lookup and of the posts of a location
+
+Fills a scratch database up to the given numbers of users and posts in
+steps ten times larger each, and at every step times the user lookup of
+/api/users/verify/ (without the password hash) and the pages of
+/api/posts/locations/<id>/, the first two sorted by date and the first
+sorted by likes. With the indexes these stay flat as the tables grow
+tenfold. The query plan of each statement is checked for full table
+scans. Run from src/:
+
+    python -m bench.scale --users 1000000 --posts 10000000
+
+The full size takes several minutes to generate, pass --database to keep
+the data for later runs
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from datetime import datetime, timedelta
+from unittest import mock
+
+from sqlalchemy import event
+
+import app as app_module
+from bench.harness import print_table
+from db import User, db
+
+BATCH_SIZE = 100000
+
+
+def fill(path, users, posts, locations):
+    """
+    Inserts users and posts into the database at path until it holds the
+    given numbers of them, posts spread over locations, newest last
+    """
+    connection = sqlite3.connect(path)
+    if connection.execute("SELECT count(*) FROM location").fetchone()[0] < locations:
+        connection.executemany(
+            "INSERT INTO location (longitude, latitude, name, address, description) VALUES (?, ?, ?, ?, '')",
+            [(random.uniform(-180, 180), random.uniform(-90, 90), "location %d" % n, "address %d" % n) for n in range(locations)]
+        )
+
+    start = connection.execute("SELECT count(*) FROM user").fetchone()[0]
+    for first in range(start, users, BATCH_SIZE):
+        connection.executemany(
+            "INSERT INTO user (username, password) VALUES (?, 'not a hash')",
+            [("user%d" % n,) for n in range(first, min(users, first + BATCH_SIZE))]
+        )
+        connection.commit()
+
+    start = connection.execute("SELECT count(*) FROM post").fetchone()[0]
+    origin = datetime(2020, 1, 1)
+    for first in range(start, posts, BATCH_SIZE):
+        connection.executemany(
+            "INSERT INTO post (timestamp, comment, location_id, user_id, like_count) VALUES (?, 'comment', ?, ?, ?)",
+            [
+                (origin + timedelta(seconds = n), random.randint(1, locations), random.randint(1, users), random.randint(0, 100))
+                for n in range(first, min(posts, first + BATCH_SIZE))
+            ]
+        )
+        connection.commit()
+    connection.close()
+
+
+def statements_of(app, path):
+    """
+    Returns the statements and parameters run by a GET of path
+    """
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    with app.app_context():
+        event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            app.test_client().get(path)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", record)
+    return statements
+
+
+def full_scans(app, statements):
+    """
+    Returns the plan steps of the statements reading a whole table, e.g.
+    "SCAN post", as opposed to searching or scanning an index
+    """
+    scans = set()
+    with app.app_context():
+        connection = db.session.connection().connection
+        for statement, parameters in statements:
+            for row in connection.execute("EXPLAIN QUERY PLAN " + statement, parameters):
+                step = row[-1]
+                if step.startswith("SCAN") and "USING" not in step:
+                    scans.add(step)
+        db.session.remove()
+    return scans
+
+
+def timed(fn, samples):
+    """
+    Returns the mean milliseconds of fn(n) over n in range(samples)
+    """
+    start = time.perf_counter()
+    for n in range(samples):
+        fn(n)
+    return 1000 * (time.perf_counter() - start) / samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type = int, default = 1000000)
+    parser.add_argument("--posts", type = int, default = 10000000)
+    parser.add_argument("--locations", type = int, default = 1000)
+    parser.add_argument("--steps", type = int, default = 4, help = "sizes measured, each ten times the previous one")
+    parser.add_argument("--samples", type = int, default = 200, help = "requests timed per query and size")
+    parser.add_argument("--database", help = "SQLite file to fill, kept after the run")
+    args = parser.parse_args()
+    logging.getLogger("queries").setLevel(logging.ERROR)
+
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.abspath(args.database or os.path.join(folder, "scale.db"))
+        with mock.patch.dict(os.environ, {"DATABASE_URL": "sqlite:///" + path}):
+            app_module.upgrade_database("production")
+            app = app_module.create_app("production")
+
+        client = app.test_client()
+        rows = []
+        scans = set()
+        for step in reversed(range(args.steps)):
+            users = max(1, args.users // 10 ** step)
+            posts = max(1, args.posts // 10 ** step)
+            fill(path, users, posts, args.locations)
+
+            def login(n):
+                with app.app_context():
+                    User.query.filter_by(username = "user%d" % random.randrange(users)).first()
+                    db.session.remove()
+
+            def page(sort, cursors = None):
+                def get(n):
+                    location = n % args.locations + 1
+                    url = "/api/posts/locations/%d/?sort=%s&limit=20&user_id=1" % (location, sort)
+                    if cursors is not None:
+                        location, cursor = cursors[n % len(cursors)]
+                        url = "/api/posts/locations/%d/?sort=%s&limit=20&user_id=1&cursor=%s" % (location, sort, cursor)
+                    return json.loads(client.get(url).data)["next_cursor"]
+                return get
+
+            # locations with a second page, there may be none at the smallest size
+            cursors = [(n + 1, page("recent")(n)) for n in range(min(args.samples, args.locations))]
+            cursors = [(location, cursor) for location, cursor in cursors if cursor is not None]
+            rows.append([
+                users, posts, timed(login, args.samples), timed(page("recent"), args.samples),
+                timed(page("recent", cursors), args.samples) if cursors else "-", timed(page("likes"), args.samples)
+            ])
+
+            with app.app_context():
+                login_statement = str(User.query.filter_by(username = "user0").statement.compile(compile_kwargs = {"literal_binds": True}))
+            scans |= full_scans(app, [(login_statement, ())])
+            for sort in ("recent", "likes"):
+                scans |= full_scans(app, statements_of(app, "/api/posts/locations/1/?sort=%s&limit=20&user_id=1" % sort))
+
+    print_table(["users", "posts", "login ms", "recent ms", "page 2 ms", "likes ms"], rows)
+    print("full table scans: %s" % (", ".join(sorted(scans)) or "none"))
+
+
+if __name__ == "__main__":
+    main()
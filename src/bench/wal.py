@@ -0,0 +1,92 @@
+"""
+Mixed read, like and post benchmark of the SQLite tuning, run with the
+tuning of db.py (WAL, synchronous=NORMAL, busy timeout, page cache, mmap,
+pooled connections) and without it (SQLite and SQLAlchemy defaults)
+
+Every operation posts at a location, toggles a like and reads the location's
+posts sorted by likes, from concurrent threads of one app, each variant on a
+fresh database. Run from src/:
+
+    python -m bench.wal --operations 400 --threads 8
+"""
+import argparse
+import json
+import logging
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from unittest import mock
+
+from sqlalchemy import text
+
+import app as app_module
+import db as db_module
+from bench.harness import print_table
+
+
+def run(tuned, folder, operations, threads, users):
+    """
+    Runs the workload on a fresh database, with or without the tuning
+    Returns the journal mode, the seconds it took and the number of failed requests
+    """
+    with ExitStack() as stack:
+        stack.enter_context(mock.patch.dict(os.environ, {
+            "DATABASE_URL": "sqlite:///" + os.path.join(folder, "%s.db" % ("tuned" if tuned else "default"))
+        }))
+        if not tuned:
+            stack.enter_context(mock.patch.dict(db_module.SQLITE_PRAGMAS, clear = True))
+            stack.enter_context(mock.patch.object(app_module, "engine_options", lambda uri: {}))
+
+        app_module.upgrade_database("production")
+        app = app_module.create_app("production")
+        client = app.test_client()
+        for n in range(users):
+            client.post("/api/users/", data = json.dumps({"username": "user%d" % n, "password": "password"}))
+        client.post("/api/locations/", data = json.dumps(
+            {"longitude": -76.5, "latitude": 42.44, "name": "location", "address": "address", "description": ""}
+        ))
+
+        def operation(n):
+            client = app.test_client()
+            user_id = n % users + 1
+            statuses = [
+                client.post("/api/posts/", data = json.dumps({"comment": "comment", "location_id": 1, "user_id": user_id})).status_code,
+                client.post("/api/posts/%d/like/" % (n // 2 + 1), data = json.dumps({"user_id": user_id})).status_code,
+                client.get("/api/posts/locations/1/?sort=likes&limit=20&user_id=%d" % user_id).status_code
+            ]
+            return sum(status >= 500 for status in statuses)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(threads) as executor:
+            failures = sum(executor.map(operation, range(operations)))
+        seconds = time.perf_counter() - start
+
+        with app.app_context():
+            journal_mode = db_module.db.session.execute(text("PRAGMA journal_mode")).scalar()
+            db_module.db.session.remove()
+            db_module.db.engine.dispose()
+        return journal_mode, seconds, failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--operations", type = int, default = 400, help = "post, like and read triples")
+    parser.add_argument("--threads", type = int, default = 8)
+    parser.add_argument("--users", type = int, default = 20)
+    args = parser.parse_args()
+    # the slow statements of the untuned run are expected
+    logging.getLogger("queries").setLevel(logging.ERROR)
+
+    rows = []
+    with tempfile.TemporaryDirectory() as folder:
+        for tuned in (False, True):
+            journal_mode, seconds, failures = run(tuned, folder, args.operations, args.threads, args.users)
+            rows.append(["tuned" if tuned else "defaults", journal_mode, seconds, args.operations * 3 / seconds, failures])
+
+    print_table(["sqlite", "journal", "seconds", "requests/s", "failed"], rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+import fcntl
+import mmap
+import os
+import random
+import struct
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+from threading import Condition, Lock
+
+
+class TTLCache:
+    """
+    Thread-safe LRU cache whose entries expire after a per-entry time to live
+
+    Expired entries are not dropped until evicted, so they can still be read
+    with get_stale when a fresh value cannot be obtained
+    """
+
+    def __init__(self, maxsize = 1024):
+        """
+        Initialize an empty cache holding at most maxsize entries
+        """
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Returns the value cached under key, None if missing or expired
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] <= time.monotonic():
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def __contains__(self, key):
+        """
+        Whether a fresh value is cached under key, without touching the counters
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry is not None and entry[1] > time.monotonic()
+
+    def get_stale(self, key):
+        """
+        Returns the value cached under key even if expired, None if missing
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            return None if entry is None else entry[0]
+
+    def get_with_ttl(self, key):
+        """
+        Returns (value, seconds it stays fresh) cached under key, negative
+        seconds once expired, None if missing
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            return None if entry is None else (entry[0], entry[1] - time.monotonic())
+
+    def set(self, key, value, ttl):
+        """
+        Caches value under key for ttl seconds, evicting the least recently used entry if full
+        """
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last = False)
+
+    def stats(self):
+        """
+        Returns the hit and miss counters and the current size of the cache
+        """
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self.entries)}
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls sharing a key, so that only the first caller
+    runs the function while the others wait for and share its result
+    """
+
+    def __init__(self):
+        """
+        Initialize with no call in flight
+        """
+        self.calls = {}
+        self.lock = Lock()
+
+    def do(self, key, fn, *args):
+        """
+        Returns fn(*args), or the result of the identical call already in flight for key
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Future()
+
+        if not leader:
+            return call.result()
+
+        try:
+            result = fn(*args)
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+
+class VersionCounters:
+    """
+    Latest known version number of each named table, only ever advanced
+
+    Once opened on a file, the counters are memory-mapped from it and shared
+    by every process of the host, so that a version seen by one worker is
+    seen by all of them. Reading a counter is a plain memory access
+    """
+
+    SLOT = struct.Struct("<Q")
+
+    def __init__(self, names):
+        """
+        Initialize in-process counters, all 0, for the given table names
+        """
+        self.slots = {name: n for n, name in enumerate(names)}
+        self.memory = bytearray(self.SLOT.size * len(self.slots))
+        self.fd = None
+        self.lock = Lock()
+
+    def open(self, path):
+        """
+        Shares the counters through the file at path, created if missing
+        """
+        size = self.SLOT.size * len(self.slots)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(fd).st_size < size:
+            os.ftruncate(fd, size)
+        with self.lock:
+            if self.fd is not None:
+                self.memory.close()
+                os.close(self.fd)
+            self.memory = mmap.mmap(fd, size)
+            self.fd = fd
+
+    def get(self, name):
+        """
+        Returns the current version of a table
+        """
+        return self.SLOT.unpack_from(self.memory, self.SLOT.size * self.slots[name])[0]
+
+    def advance(self, versions):
+        """
+        Raises the counters to the given versions, a mapping of table name to
+        version, leaving those already at or past them
+        """
+        with self.lock:
+            if self.fd is not None:
+                fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                for name, version in versions.items():
+                    if name not in self.slots:
+                        continue
+                    offset = self.SLOT.size * self.slots[name]
+                    if self.SLOT.unpack_from(self.memory, offset)[0] < version:
+                        self.SLOT.pack_into(self.memory, offset, version)
+            finally:
+                if self.fd is not None:
+                    fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+
+class HostSemaphore:
+    """
+    Semaphore of a number of slots, shared by the threads of the process
+
+    Once opened on a file, it is shared by every process of the host: each
+    slot is a byte of the file, held with a POSIX record lock, which the
+    system releases if the process dies
+    """
+
+    # seconds between two attempts while every slot of the host is taken
+    POLL_INTERVAL = 0.01
+
+    def __init__(self, slots):
+        """
+        Initialize an in-process semaphore of the given number of slots
+        """
+        self.slots = slots
+        # slots no thread of this process holds, record locks do not exclude threads of the same process
+        self.free = set(range(slots))
+        self.condition = Condition()
+        self.fd = None
+
+    def open(self, path):
+        """
+        Shares the slots through the file at path, created if missing
+        """
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        with self.condition:
+            if self.fd is not None:
+                os.close(self.fd)
+            self.fd = fd
+
+    def try_acquire(self):
+        """
+        Takes a free slot of the host and returns it, None if all are taken
+        """
+        with self.condition:
+            for slot in random.sample(sorted(self.free), len(self.free)):
+                if self.fd is not None:
+                    try:
+                        fcntl.lockf(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, slot)
+                    except OSError:
+                        continue
+                self.free.discard(slot)
+                return slot
+            return None
+
+    def acquire(self):
+        """
+        Takes a slot, waiting until one of the host is free, and returns it
+        """
+        while True:
+            with self.condition:
+                while not self.free:
+                    self.condition.wait()
+            slot = self.try_acquire()
+            if slot is not None:
+                return slot
+            time.sleep(self.POLL_INTERVAL)
+
+    def release(self, slot):
+        """
+        Frees a slot taken by acquire or try_acquire
+        """
+        with self.condition:
+            if self.fd is not None:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, slot)
+            self.free.add(slot)
+            self.condition.notify()
+
+    @contextmanager
+    def hold(self):
+        """
+        Holds a slot for the duration of the with block
+        """
+        slot = self.acquire()
+        try:
+            yield
+        finally:
+            self.release(slot)
@@ -1,17 +1,100 @@
+import logging
+import os
+import sqlite3
+
+from dotenv import load_dotenv
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import Float, MetaData, event, inspect, text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, selectinload
+from sqlalchemy.pool import QueuePool
+
+from replicas import RoutingSession
+
+load_dotenv()
+
+db = SQLAlchemy(session_options = {"class_": RoutingSession})
+logger = logging.getLogger(__name__)
+
+# applied to every new SQLite connection, in this order
+SQLITE_PRAGMAS = {
+    # readers no longer block writers nor the other way around
+    "journal_mode": "WAL",
+    # in WAL mode, only syncs at checkpoints, a power loss may lose the last commits but never corrupts
+    "synchronous": "NORMAL",
+    # milliseconds a writer waits for the lock before failing with "database is locked"
+    "busy_timeout": int(os.environ.get("SQLITE_BUSY_TIMEOUT", 5000)),
+    "mmap_size": int(os.environ.get("SQLITE_MMAP_SIZE", 256 * 1024 * 1024)),
+    # negative values are in KiB
+    "cache_size": -int(os.environ.get("SQLITE_CACHE_KB", 64 * 1024)),
+    "temp_store": "MEMORY"
+}
+
+
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    Tunes every new SQLite connection with SQLITE_PRAGMAS
+    """
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute("PRAGMA %s = %s" % (name, value))
+    cursor.close()
 
-db = SQLAlchemy()
+
+def engine_options(uri):
+    """
+    Returns the engine options of the database at uri
+
+    Every database is opened through a pool of connections kept open for the
+    life of the worker and shared by its threads. For a SQLite file this
+    replaces the default of one connection per session, so that the pragmas
+    and page cache of each connection are reused
+    """
+    url = make_url(uri)
+    if url.drivername.startswith("sqlite") and url.database in (None, "", ":memory:"):
+        return {}
+
+    options = {
+        "pool_size": int(os.environ.get("DB_POOL_SIZE", 5)),
+        "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", 5))
+    }
+    if url.drivername.startswith("sqlite"):
+        options["poolclass"] = QueuePool
+        options["connect_args"] = {"check_same_thread": False}
+    else:
+        # database servers may close connections left idle
+        options["pool_pre_ping"] = True
+    return options
+
+def insert_ignoring_duplicates(table):
+    """
+    Returns an insert into table which adds no row, instead of failing, when
+    the row would duplicate a unique index, the result rowcount telling which
+    """
+    if db.engine.dialect.name == "postgresql":
+        return postgresql.insert(table).on_conflict_do_nothing()
+    return sqlite.insert(table).on_conflict_do_nothing()
 
 assoc_features_locations = db.Table(
     "association_features_locations",
     db.Column("feature_id", db.Integer, db.ForeignKey("feature.id")),
-    db.Column("location_id", db.Integer, db.ForeignKey("location.id"))
+    db.Column("location_id", db.Integer, db.ForeignKey("location.id")),
+    db.Index("ix_features_locations_feature_id_location_id", "feature_id", "location_id", unique = True),
+    db.Index("ix_features_locations_location_id", "location_id")
 )
 
 assoc_posts_users_likes = db.Table(
     "association_posts_users_likes",
     db.Column("user_id", db.Integer, db.ForeignKey("user.id")),
-    db.Column("post_id", db.Integer, db.ForeignKey("post.id"))
+    db.Column("post_id", db.Integer, db.ForeignKey("post.id")),
+    db.Index("ix_likes_user_id_post_id", "user_id", "post_id", unique = True),
+    db.Index("ix_likes_post_id", "post_id")
 )
 
 class Feature(db.Model):
@@ -21,7 +104,7 @@ class Feature(db.Model):
 
     __tablename__ = "feature"
     id = db.Column(db.Integer, primary_key = True, autoincrement = True)
-    name = db.Column(db.String, nullable = False)
+    name = db.Column(db.String, nullable = False, unique = True, index = True)
     locations = db.relationship("Location", secondary = assoc_features_locations, back_populates = "features")
 
     def __init__(self, **kwargs):
@@ -57,8 +140,8 @@ class Location(db.Model):
     """
     __tablename__ = "location"
     id = db.Column(db.Integer, primary_key = True, autoincrement = True)
-    longitude = db.Column(db.String, nullable = False)
-    latitude = db.Column(db.String, nullable = False)
+    longitude = db.Column(db.Float, nullable = False)
+    latitude = db.Column(db.Float, nullable = False)
     name = db.Column(db.String, nullable = False)
     address = db.Column(db.String, nullable = False)
     description = db.Column(db.String, nullable = False)
@@ -70,8 +153,8 @@ class Location(db.Model):
         Initialize a location object
         """
 
-        self.longitude = kwargs.get("longitude", "0.0")
-        self.latitude = kwargs.get("latitude", "0.0")
+        self.longitude = kwargs.get("longitude", 0.0)
+        self.latitude = kwargs.get("latitude", 0.0)
         self.name = kwargs.get("name", "")
         self.address = kwargs.get("address", "")
         self.description = kwargs.get("description", "")
@@ -82,8 +165,8 @@ class Location(db.Model):
         """
         return {
             "id": self.id,
-            "longitude": self.longitude,
-            "latitude": self.latitude,
+            "longitude": str(self.longitude),
+            "latitude": str(self.latitude),
             "name": self.name,
             "address": self.address,
             "description": self.description,
@@ -97,8 +180,8 @@ class Location(db.Model):
         """
         return {
             "id": self.id,
-            "longitude": self.longitude,
-            "latitude": self.latitude,
+            "longitude": str(self.longitude),
+            "latitude": str(self.latitude),
             "name": self.name,
             "address": self.address,
             "description": self.description,
@@ -114,9 +197,18 @@ class Post(db.Model):
     timestamp = db.Column(db.TIMESTAMP, nullable = False)
     comment = db.Column(db.String, nullable = False)
     location_id = db.Column(db.Integer, db.ForeignKey("location.id"), nullable = False)
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable = False)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable = False, index = True)
+    like_count = db.Column(db.Integer, nullable = False, default = 0, server_default = "0")
+    user = db.relationship("User", back_populates = "posts")
     liked_users = db.relationship("User", secondary = assoc_posts_users_likes, back_populates = "posts_liked")
 
+    # keysets of the pages of posts by location, read in index order without sorting,
+    # which also serve the lookups by location_id
+    __table_args__ = (
+        db.Index("ix_post_location_id_timestamp_id", "location_id", "timestamp", "id"),
+        db.Index("ix_post_location_id_like_count_id", "location_id", "like_count", "id")
+    )
+
     def __init__(self, **kwargs):
         """
         Initialize a post object
@@ -126,6 +218,7 @@ class Post(db.Model):
         self.comment = kwargs.get("comment", "")
         self.location_id = kwargs.get("location_id", "")
         self.user_id = kwargs.get("user_id", "")
+        self.like_count = 0
 
     def serialize(self):
         """
@@ -137,7 +230,8 @@ class Post(db.Model):
             "comment": self.comment,
             "location_id": self.location_id,
             "user_id": self.user_id,
-            "username": User.query.filter_by(id = self.user_id).first().username,
+            "username": self.user.username,
+            "like_count": self.like_count,
             "liked_users": [user.simple_serialize() for user in self.liked_users]
         }
     
@@ -151,7 +245,8 @@ class Post(db.Model):
             "timestamp": str(self.timestamp),
             "location_id": self.location_id,
             "user_id": self.user_id,
-            "username": User.query.filter_by(id = self.user_id).first().username
+            "username": self.user.username,
+            "like_count": self.like_count
         }
     
     def checked_serialize(self, uid):
@@ -164,11 +259,20 @@ class Post(db.Model):
             "comment": self.comment,
             "location_id": self.location_id,
             "user_id": self.user_id,
-            "username": User.query.filter_by(id = self.user_id).first().username,
+            "username": self.user.username,
+            "like_count": self.like_count,
             "liked_users": [user.simple_serialize() for user in self.liked_users],
             "is_editable": uid == self.user_id
         }
 
+    @staticmethod
+    def serialize_options():
+        """
+        Loader options resolving authors and liked users of a whole result set
+        in a constant number of queries, to be used by every post listing
+        """
+        return (joinedload(Post.user), selectinload(Post.liked_users))
+
 class User(db.Model):
     """
     User Model
@@ -176,9 +280,9 @@ class User(db.Model):
 
     __tablename__ = "user"
     id = db.Column(db.Integer, primary_key = True, autoincrement = True)
-    username = db.Column(db.String, nullable = False)
+    username = db.Column(db.String, nullable = False, unique = True, index = True)
     password = db.Column(db.String, nullable = False)
-    posts = db.relationship("Post", cascade = "delete")
+    posts = db.relationship("Post", cascade = "delete", back_populates = "user")
     posts_liked = db.relationship("Post", secondary = assoc_posts_users_likes, back_populates = "liked_users")
 
     def __init__(self, **kwargs):
@@ -189,18 +293,6 @@ class User(db.Model):
         self.username = kwargs.get("username", "")
         self.password = kwargs.get("password", "")
 
-    def serialize(self):
-        """
-        Serialize a user object
-        """
-        return {
-            "id": self.id,
-            "username": self.username,
-            "posts": [post.serialize() for post in self.posts],
-            "post_liked": [post.serialize() for post in self.posts_liked]
-        }
-    
-    
     def simple_serialize(self):
         """
         Serialize a user object without posts field
@@ -209,4 +301,141 @@ class User(db.Model):
             "id": self.id,
             "username": self.username
         }
-    
\ No newline at end of file
+    
+
+class Image(db.Model):
+    """
+    Image Model
+    Metadata of the image file stored for a post or a user
+    """
+
+    __tablename__ = "image"
+    id = db.Column(db.Integer, primary_key = True, autoincrement = True)
+    owner_type = db.Column(db.String, nullable = False)
+    owner_id = db.Column(db.Integer, nullable = False)
+    extension = db.Column(db.String, nullable = False)
+    size = db.Column(db.Integer, nullable = False)
+    content_hash = db.Column(db.String, nullable = False, index = True)
+    mtime = db.Column(db.Float, nullable = False)
+
+    __table_args__ = (db.Index("ix_image_owner_type_owner_id", "owner_type", "owner_id", unique = True),)
+
+    def __init__(self, **kwargs):
+        """
+        Initialize an image object
+        """
+
+        self.owner_type = kwargs.get("owner_type", "")
+        self.owner_id = kwargs.get("owner_id")
+        self.extension = kwargs.get("extension", "")
+        self.size = kwargs.get("size", 0)
+        self.content_hash = kwargs.get("content_hash", "")
+        self.mtime = kwargs.get("mtime", 0.0)
+
+    @staticmethod
+    def find_all(owner_type, owner_ids):
+        """
+        Returns the images of the given owners keyed by owner id, in one query
+        """
+        if not owner_ids:
+            return {}
+        images = Image.query.filter(Image.owner_type == owner_type, Image.owner_id.in_(owner_ids))
+        return {image.owner_id: image for image in images}
+
+
+class Blob(db.Model):
+    """
+    Blob Model
+    Image file stored once per distinct content, shared by every image with that content
+    """
+
+    __tablename__ = "blob"
+    content_hash = db.Column(db.String, primary_key = True)
+    extension = db.Column(db.String, nullable = False)
+    size = db.Column(db.Integer, nullable = False)
+    ref_count = db.Column(db.Integer, nullable = False, default = 0)
+
+    def __init__(self, **kwargs):
+        """
+        Initialize a blob object
+        """
+
+        self.content_hash = kwargs.get("content_hash")
+        self.extension = kwargs.get("extension", "")
+        self.size = kwargs.get("size", 0)
+        self.ref_count = kwargs.get("ref_count", 0)
+
+
+class TableVersion(db.Model):
+    """
+    TableVersion Model
+    Version number of a table, bumped in the transaction of every write to it
+    """
+
+    __tablename__ = "table_version"
+    name = db.Column(db.String, primary_key = True)
+    version = db.Column(db.Integer, nullable = False, default = 0)
+
+
+def convert_location_coordinates(connection):
+    """
+    Rebuilds the location table with float coordinates, since SQLite cannot
+    change the type of an existing column
+    """
+    table = Location.__table__
+    new_table = table.to_metadata(MetaData(), name = "location_new")
+    new_table.create(bind = connection)
+
+    columns = [column.name for column in table.columns]
+    values = [
+        "CAST(%s AS REAL)" % column if column in ("longitude", "latitude") else column
+        for column in columns
+    ]
+    connection.execute(text(
+        "INSERT INTO location_new (%s) SELECT %s FROM location" % (", ".join(columns), ", ".join(values))
+    ))
+    connection.execute(text("DROP TABLE location"))
+    connection.execute(text("ALTER TABLE location_new RENAME TO location"))
+
+
+def upgrade_schema():
+    """
+    Brings an existing database up to date with the models
+    create_all only creates missing tables, so columns and indexes added
+    to existing tables are created here
+
+    Every index is built in its own transaction, so the write lock is only
+    held for one index at a time while the server keeps serving reads
+    """
+    with db.engine.begin() as connection:
+        location_columns = {column["name"]: column["type"] for column in inspect(connection).get_columns("location")}
+        if not isinstance(location_columns["longitude"], Float):
+            convert_location_coordinates(connection)
+
+        post_columns = {column["name"] for column in inspect(connection).get_columns("post")}
+        if "like_count" not in post_columns:
+            connection.execute(text("ALTER TABLE post ADD COLUMN like_count INTEGER NOT NULL DEFAULT 0"))
+            connection.execute(text(
+                "UPDATE post SET like_count = "
+                # distinct, the duplicate likes of old databases are only dropped further down
+                "(SELECT count(DISTINCT user_id) FROM association_posts_users_likes WHERE post_id = post.id)"
+            ))
+
+    for table in db.metadata.sorted_tables:
+        existing = {index["name"] for index in inspect(db.engine).get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+
+            try:
+                with db.engine.begin() as connection:
+                    if table.name.startswith("association_") and index.unique:
+                        # association rows carry no data, so duplicates can simply be dropped
+                        columns = ", ".join(column.name for column in index.columns)
+                        connection.execute(text(
+                            "DELETE FROM %s WHERE rowid NOT IN (SELECT min(rowid) FROM %s GROUP BY %s)"
+                            % (table.name, table.name, columns)
+                        ))
+                    index.create(bind = connection)
+            except IntegrityError:
+                logger.warning("index %s not created, %s contains duplicate values", index.name, table.name)
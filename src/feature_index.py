@@ -0,0 +1,89 @@
+from threading import Lock
+
+
+class FeatureIndex:
+    """
+    In-memory index of the locations tagged with each feature
+
+    The locations of a feature are a bitset held in a Python int, bit n being
+    set if location n has the feature, so that filtering by several features
+    is one AND or OR per feature however many locations there are
+    """
+
+    def __init__(self):
+        """
+        Initialize an empty index
+        """
+        self.ids = {}
+        self.locations = {}
+        self.version = None
+        self.lock = Lock()
+        # held by the thread rebuilding the index, so that concurrent syncs rebuild it once
+        self.rebuild_lock = Lock()
+
+    def rebuild(self, features, links, version = None):
+        """
+        Replaces the content of the index with features, an iterable of
+        (id, name), and links, an iterable of (feature id, location id)
+        version identifies the state of the database the content was read from
+        """
+        ids = {}
+        bits = {}
+        for feature_id, name in features:
+            ids[name] = feature_id
+            bits[feature_id] = bytearray()
+
+        # bits are set in bytes, each bitset becomes an int once, instead of copying it for every link
+        for feature_id, location_id in links:
+            array = bits.get(feature_id)
+            if array is None or location_id is None:
+                continue
+            byte = location_id >> 3
+            if byte >= len(array):
+                array.extend(bytes(byte + 1 - len(array)))
+            array[byte] |= 1 << (location_id & 7)
+        locations = {feature_id: int.from_bytes(array, "little") for feature_id, array in bits.items()}
+
+        with self.lock:
+            self.ids = ids
+            self.locations = locations
+            self.version = version
+
+    def __contains__(self, name):
+        """
+        Whether a feature with this name exists
+        """
+        return name in self.ids
+
+    def match(self, names, match_all = True):
+        """
+        Returns the ids of the locations having all the named features, or
+        any of them if match_all is False, in increasing order
+        Unknown names match no location
+        """
+        with self.lock:
+            bitsets = [self.locations.get(self.ids.get(name), 0) for name in names]
+
+        if not bitsets:
+            return []
+
+        result = bitsets[0]
+        for bitset in bitsets[1:]:
+            result = result & bitset if match_all else result | bitset
+        return self.to_ids(result)
+
+    @staticmethod
+    def to_ids(bitset):
+        """
+        Returns the positions of the bits set in bitset, in increasing order
+        """
+        bits = bin(bitset)[:1:-1]
+        ids = []
+        position = bits.find("1")
+        while position != -1:
+            ids.append(position)
+            position = bits.find("1", position + 1)
+        return ids
+
+
+feature_index = FeatureIndex()
@@ -0,0 +1,45 @@
+import multiprocessing
+import os
+import subprocess
+import sys
+
+# Production server settings, used with: gunicorn wsgi:app
+# Send HUP to the master to reload the code gracefully: new workers are
+# started and old ones finish their in-flight requests before exiting
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:8000")
+
+# one process per core serves CPU-bound work, threads overlap the time
+# requests spend waiting on the database and the weather API
+workers = int(os.environ.get("GUNICORN_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+worker_class = "gthread"
+
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 30))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", 30))
+keepalive = 5
+
+# recycle workers periodically, jittered so they do not all restart at once
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", 10000))
+max_requests_jitter = max_requests // 10
+
+accesslog = "-"
+
+
+def upgrade_schema(server):
+    """
+    Upgrades the database schema once, before any worker opens it
+
+    Runs in a child process, so that the master never imports the app:
+    workers forked from it would otherwise inherit the modules it loaded,
+    and keep serving the old code after HUP
+    """
+    subprocess.run(
+        [sys.executable, "-c", "from app import upgrade_database; upgrade_database('production')"],
+        check = True
+    )
+
+
+# at startup, and on HUP before the new workers load the new code
+on_starting = upgrade_schema
+on_reload = upgrade_schema
@@ -1,44 +1,490 @@
-from flask import Flask, request, send_file
-from db import Post, User
-import json
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, current_app, request, send_file, url_for
+from db import db, Blob, Image, Post, User, insert_ignoring_duplicates
+from metrics import Counter
+from responses import failure_response, success_response
+from sqlalchemy import update
+import glob
+import hashlib
+import logging
 import os
+import tempfile
+import time
+from werkzeug.exceptions import RequestEntityTooLarge
 
-def success_response(body, code = 200):
-    return json.dumps(body), code
+try:
+    from PIL import Image as PILImage
+except ImportError:
+    PILImage = None
 
-def failure_response(message, code = 404):
-    return json.dumps({"error": message}), code
+logger = logging.getLogger(__name__)
 
+# leading bytes identifying each supported image format, and the extension it is stored with
+MAGIC_BYTES = {b'\x89PNG\r\n\x1a\n': 'png', b'\xff\xd8\xff': 'jpg'}
+CHUNK_SIZE = 64 * 1024
+# age in seconds past which a file no blob refers to is no upload in progress
+ORPHAN_GRACE_SECONDS = 3600
 
+executor = ThreadPoolExecutor(max_workers = int(os.environ.get("IMAGE_WORKERS", 2)))
 
-def image_route(app):
+bytes_served = Counter("image_bytes_served_total", "Bytes of image files sent, variants included", ("owner_type",))
+
+
+class CappedStream:
+    """
+    Request body of unknown length, read until its end, which raises
+    RequestEntityTooLarge once more than limit bytes were read
+    """
+
+    def __init__(self, stream, limit):
+        """
+        Initialize a stream reading at most limit bytes from stream
+        """
+        self.stream = stream
+        self.limit = limit
+        self.consumed = 0
+
+    def read(self, size = -1):
+        """
+        Reads up to size bytes, all of them up to the limit if size is negative
+        """
+        # one byte past the limit tells a body of exactly limit bytes from a larger one
+        remaining = self.limit - self.consumed + 1
+        data = self.stream.read(remaining if size is None or size < 0 else min(size, remaining))
+        self.consumed += len(data)
+        if self.consumed > self.limit:
+            raise RequestEntityTooLarge()
+        return data
+
+    def readline(self, size = -1):
+        """
+        Reads up to the end of the line, within the limit
+        """
+        remaining = self.limit - self.consumed + 1
+        data = self.stream.readline(remaining if size is None or size < 0 else min(size, remaining))
+        self.consumed += len(data)
+        if self.consumed > self.limit:
+            raise RequestEntityTooLarge()
+        return data
+
+
+#### BLOB STORE ####
+# Image files are stored once per distinct content, as
+# IMAGE_FOLDER_BLOBS/<hash[:2]>/<hash[2:4]>/<hash>.<extension>, next to their
+# resized variants <hash>.<size>.<extension>. Every blob counts the images
+# referencing it, and is deleted with its variants once that count drops to 0.
+
+def blob_path(content_hash, extension, size = None, folder = None):
+    """
+    Returns the path of a blob, or of one of its variants if size is given
+    """
+    folder = folder or current_app.config['IMAGE_FOLDER_BLOBS']
+    name = f"{content_hash}.{extension}" if size is None else f"{content_hash}.{size}.{extension}"
+    return os.path.join(folder, content_hash[:2], content_hash[2:4], name)
+
+def generate_variants(path, content_hash, extension, folder, sizes, webp):
+    """
+    Writes the resized variants of the blob at path, and their WebP version if enabled
+    Runs in the worker pool, each variant is written atomically once complete
+    """
+    try:
+        with PILImage.open(path) as original:
+            original.load()
+            for size, edge in sizes.items():
+                variant = original.copy()
+                variant.thumbnail((edge, edge))
+
+                formats = [(extension, "PNG" if extension == "png" else "JPEG")]
+                if webp:
+                    formats.append(("webp", "WEBP"))
+
+                for variant_extension, variant_format in formats:
+                    if variant_format == "JPEG" and variant.mode != "RGB":
+                        variant = variant.convert("RGB")
+                    target = blob_path(content_hash, variant_extension, size, folder)
+                    variant.save(target + ".tmp", variant_format)
+                    os.replace(target + ".tmp", target)
+    except Exception:
+        logger.exception("could not generate variants of %s", path)
+
+def submit_variants(path, content_hash, extension):
+    """
+    Schedules the generation of the variants of a new blob, if Pillow is available
+    """
+    if PILImage is None:
+        return
+    executor.submit(
+        generate_variants, path, content_hash, extension, current_app.config['IMAGE_FOLDER_BLOBS'],
+        current_app.config['IMAGE_SIZES'], current_app.config['IMAGE_WEBP']
+    )
+
+def store_blob(temp_path, content_hash, extension, size):
+    """
+    Adds a reference to the blob with the given content, in the current
+    transaction. The file at temp_path is moved into the store if the
+    content is new, and discarded otherwise
+
+    The blob may be added by a concurrent upload of the same content, or
+    deleted by a concurrent collect_blobs, in between, so its reference is
+    added by whichever of the update and the insert finds it in its state
+    """
+    path = blob_path(content_hash, extension)
+    increment = update(Blob).where(Blob.content_hash == content_hash).values(ref_count = Blob.ref_count + 1)
+
+    if db.session.execute(increment, execution_options = {"synchronize_session": False}).rowcount == 1:
+        if os.path.exists(path):
+            os.remove(temp_path)
+        else:
+            # left without its files by a collection that failed to commit
+            os.replace(temp_path, path)
+            submit_variants(path, content_hash, extension)
+        return
+
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    os.replace(temp_path, path)
+    inserted = db.session.execute(
+        insert_ignoring_duplicates(Blob.__table__)
+            .values(content_hash = content_hash, extension = extension, size = size, ref_count = 1)
+    )
+    if inserted.rowcount == 1:
+        submit_variants(path, content_hash, extension)
+    else:
+        # a concurrent upload of the same content inserted it first
+        db.session.execute(increment, execution_options = {"synchronize_session": False})
+
+def release_blobs(content_hashes):
+    """
+    Removes one reference from each given blob, in the current transaction
+    """
+    for content_hash in content_hashes:
+        db.session.execute(
+            update(Blob).where(Blob.content_hash == content_hash).values(ref_count = Blob.ref_count - 1),
+            execution_options = {"synchronize_session": False}
+        )
+
+def collect_blobs(content_hashes):
+    """
+    Deletes the blobs among content_hashes that are no longer referenced,
+    together with their files and variants
+    To be called once the transaction releasing them is committed
+
+    The files are removed before the deletion is committed, so that an
+    upload adding a reference meanwhile waits for it, then stores the
+    content again instead of pointing to removed files
+    """
+    for content_hash in set(content_hashes):
+        deleted = Blob.query.filter(Blob.content_hash == content_hash, Blob.ref_count <= 0).delete()
+        if deleted:
+            for path in glob.glob(blob_path(content_hash, "*")):
+                os.remove(path)
+        db.session.commit()
+
+def detach_images(owner_type, owner_ids):
+    """
+    Deletes the images of the given owners and releases their blobs, in the
+    current transaction
+    Returns the hashes to pass to collect_blobs once it is committed
+    """
+    if not owner_ids:
+        return []
+
+    images = Image.query.filter(Image.owner_type == owner_type, Image.owner_id.in_(owner_ids)).all()
+    content_hashes = [image.content_hash for image in images]
+    for image in images:
+        db.session.delete(image)
+    release_blobs(content_hashes)
+    return content_hashes
+
+
+# endpoint serving the image of each owner type, and the name of its id argument
+IMAGE_ENDPOINTS = {"post": ("get_post_image", "post_id"), "user": ("get_user_image", "user_id")}
+
+def add_image_urls(owner_type, items):
+    """
+    Sets the image_url of each serialized post or user in items, None if it
+    has no image, resolving all of them in one query instead of one request
+    per item. The urls are versioned with the content hash, so clients may
+    cache the images they point to forever
+    """
+    endpoint, argument = IMAGE_ENDPOINTS[owner_type]
+    images = Image.find_all(owner_type, [item["id"] for item in items])
+    for item in items:
+        image = images.get(item["id"])
+        item["image_url"] = None if image is None else url_for(endpoint, **{argument: item["id"]}, v = image.content_hash)
+    return items
+
+
+# folders where images were stored as <owner id>.<extension> before the blob store
+LEGACY_FOLDER_KEYS = {"post": 'IMAGE_FOLDER_POST', "user": 'IMAGE_FOLDER_USER'}
+
+def find_image(owner_type, owner_id):
+    """
+    Returns the image row of the given owner, None if it has no image
+    """
+    return Image.query.filter_by(owner_type = owner_type, owner_id = owner_id).first()
+
+def legacy_images_exist():
+    """
+    Returns whether images are still stored in the folders used before the blob store
+    """
+    for folder_key in LEGACY_FOLDER_KEYS.values():
+        folder = current_app.config[folder_key]
+        if os.path.isdir(folder) and any(filename.partition('.')[0].isdigit() for filename in os.listdir(folder)):
+            return True
+    return False
+
+def reindex_images():
+    """
+    Reconciles the image metadata with the files on disk
+    Moves images still stored as images/<posts|users>/<id>.<extension> into
+    the blob store, forgets images whose owner or blob is missing, recounts
+    the references of every blob and deletes the unreferenced ones, and the
+    files no blob refers to
+    Returns the number of images and of blobs
+    """
+    for owner_type, folder_key in LEGACY_FOLDER_KEYS.items():
+        folder = current_app.config[folder_key]
+        if not os.path.isdir(folder):
+            continue
+        for filename in os.listdir(folder):
+            name, _, extension = filename.rpartition('.')
+            if not name.isdigit() or extension.lower() not in current_app.config['ALLOWED_EXTENSIONS']:
+                continue
+
+            path = os.path.join(folder, filename)
+            digest = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    digest.update(chunk)
+            content_hash = digest.hexdigest()
+            extension = 'jpg' if extension.lower() == 'jpeg' else extension.lower()
+
+            target = blob_path(content_hash, extension)
+            os.makedirs(os.path.dirname(target), exist_ok = True)
+            os.replace(path, target)
+            if Blob.query.filter_by(content_hash = content_hash).first() is None:
+                db.session.add(Blob(content_hash = content_hash, extension = extension, size = os.path.getsize(target)))
+                submit_variants(target, content_hash, extension)
+
+            image = find_image(owner_type, int(name)) or Image(owner_type = owner_type, owner_id = int(name))
+            image.extension = extension
+            image.size = os.path.getsize(target)
+            image.content_hash = content_hash
+            image.mtime = os.path.getmtime(target)
+            db.session.add(image)
+            db.session.commit()
+
+    owners = {
+        "post": {post_id for post_id, in db.session.query(Post.id)},
+        "user": {user_id for user_id, in db.session.query(User.id)}
+    }
+    for image in Image.query.all():
+        if image.owner_id not in owners[image.owner_type] \
+                or not os.path.exists(blob_path(image.content_hash, image.extension)):
+            db.session.delete(image)
+    db.session.commit()
+
+    references = {}
+    for image in Image.query.all():
+        references[image.content_hash] = references.get(image.content_hash, 0) + 1
+
+    unreferenced = []
+    for blob in Blob.query.all():
+        blob.ref_count = references.get(blob.content_hash, 0)
+        if blob.ref_count == 0:
+            unreferenced.append(blob.content_hash)
+    db.session.commit()
+    collect_blobs(unreferenced)
+
+    # files left by uploads that failed to commit, old enough not to belong to one in progress
+    blobs = {content_hash for content_hash, in db.session.query(Blob.content_hash)}
+    orphaned_before = time.time() - ORPHAN_GRACE_SECONDS
+    for path in glob.glob(os.path.join(current_app.config['IMAGE_FOLDER_BLOBS'], '*', '*', '*')) \
+            + glob.glob(os.path.join(current_app.config['IMAGE_FOLDER_BLOBS'], '.upload-*')):
+        content_hash = os.path.basename(path).split('.')[0]
+        if content_hash not in blobs and os.path.getmtime(path) < orphaned_before:
+            os.remove(path)
+
+    return Image.query.count(), Blob.query.count()
+
+
+def image_config(app):
+    """
+    Sets the image settings of the app and creates the blob store
+    """
     app.config['IMAGE_FOLDER_POST'] = os.path.join(os.path.dirname(__file__), 'images', 'posts')
     app.config['IMAGE_FOLDER_USER'] = os.path.join(os.path.dirname(__file__), 'images', 'users')
+    app.config['IMAGE_FOLDER_BLOBS'] = os.path.join(os.path.dirname(__file__), 'images', 'blobs')
     app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg'}
+    app.config['IMAGE_MIME_TYPES'] = {'png': 'image/png', 'jpg': 'image/jpeg', 'jpeg': 'image/jpeg', 'webp': 'image/webp'}
+    # lifetime of images requested through a versioned url (?v=<content hash>)
+    app.config['IMAGE_MAX_AGE'] = 365 * 24 * 3600
+    # longest edge in pixels of the variants generated for every upload, served with ?size=
+    app.config['IMAGE_SIZES'] = {'small': 128, 'medium': 512, 'large': 1080}
+    app.config['IMAGE_WEBP'] = os.environ.get("IMAGE_WEBP", "1") == "1"
+    app.config['IMAGE_MAX_BYTES'] = int(os.environ.get("IMAGE_MAX_BYTES", 10 * 1024 * 1024))
+    # requests whose announced length exceeds this are rejected with 413 before their body is read
+    app.config['MAX_CONTENT_LENGTH'] = app.config['IMAGE_MAX_BYTES'] + CHUNK_SIZE
 
-    def check_existance(folder_key, name):
+    os.makedirs(app.config['IMAGE_FOLDER_BLOBS'], exist_ok = True)
+
+
+def image_route(app):
+    @app.before_request
+    def cap_chunked_body():
         """
-        Check if given image name exist with any allowed extensions
-        Return path if found
-        None is not
+        Caps the bodies sent without Content-Length, e.g. chunked by the
+        client, which MAX_CONTENT_LENGTH cannot reject up front, so that
+        reading them fails with 413 once they exceed it instead of spooling
+        them whole to disk
         """
-        for extension in app.config['ALLOWED_EXTENSIONS']:
-                image_path = os.path.join(app.config[folder_key], str(name) + "." + extension)
-                if os.path.exists(image_path):
-                    return image_path  
+        if request.content_length is None and request.environ.get('wsgi.input_terminated'):
+            request.environ['wsgi.input'] = CappedStream(request.environ['wsgi.input'], app.config['MAX_CONTENT_LENGTH'])
+
+    def serve_image(image):
+        """
+        Sends an image with its content hash as ETag, answering conditional
+        and range requests. A url versioned with the content hash never
+        changes, so it may be cached forever, other urls must be revalidated
+
+        With ?size= the pre-rendered variant of that size is sent, as WebP if
+        the client accepts it, or the original while variants are not ready
+        """
+        path = blob_path(image.content_hash, image.extension)
+        extension = image.extension
+        etag = image.content_hash
+
+        size = request.args.get('size')
+        if size in app.config['IMAGE_SIZES']:
+            extensions = [extension]
+            accepted = [mimetype for mimetype, _ in request.accept_mimetypes]
+            if app.config['IMAGE_WEBP'] and 'image/webp' in accepted:
+                extensions.insert(0, 'webp')
+
+            for variant_extension in extensions:
+                candidate = blob_path(image.content_hash, variant_extension, size)
+                if os.path.exists(candidate):
+                    path = candidate
+                    extension = variant_extension
+                    etag = f"{image.content_hash}-{size}-{variant_extension}"
+                    break
+
+        response = send_file(
+            path,
+            mimetype = app.config['IMAGE_MIME_TYPES'].get(extension, 'application/octet-stream'),
+            etag = etag,
+            last_modified = image.mtime,
+            conditional = True
+        )
+        response.vary.add('Accept')
+
+        if request.args.get('v') == image.content_hash:
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = app.config['IMAGE_MAX_AGE']
+            response.cache_control.immutable = True
+        else:
+            response.cache_control.no_cache = True
+
+        if response.status_code != 304:
+            bytes_served.inc(image.owner_type, amount = response.content_length or 0)
+        return response
+
+    def sniff_extension(chunk):
+        """
+        Returns the extension of the image format the chunk starts with, None if not supported
+        """
+        for magic, extension in MAGIC_BYTES.items():
+            if chunk.startswith(magic):
+                return extension
         return None
 
-    def allowed_file(filename):
+    def save_image(owner_type, owner_id, upload):
         """
-        Checks if file has allowed extensions
+        Stores the uploaded file as the image of the given owner and records its metadata
+        Returns a failure response if the upload is rejected, None otherwise
+
+        The upload is copied chunk by chunk into a temporary file, so memory use
+        does not depend on the image size, then moved into the blob store unless
+        a blob with the same content exists. The previous image stays in place
+        until the new one is committed, so concurrent readers never see a
+        missing or partial file
         """
-        return '.' in filename and filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
+        digest = hashlib.sha256()
+        size = 0
+        extension = None
+
+        with tempfile.NamedTemporaryFile(dir = app.config['IMAGE_FOLDER_BLOBS'], prefix = '.upload-', delete = False) as f:
+            for chunk in iter(lambda: upload.stream.read(CHUNK_SIZE), b''):
+                if extension is None:
+                    extension = sniff_extension(chunk)
+                size += len(chunk)
+                if extension is None or size > app.config['IMAGE_MAX_BYTES']:
+                    break
+                digest.update(chunk)
+                f.write(chunk)
+
+        if extension is None:
+            os.remove(f.name)
+            return failure_response("file not supported", 400)
+        if size > app.config['IMAGE_MAX_BYTES']:
+            os.remove(f.name)
+            return failure_response("image too large", 413)
+
+        content_hash = digest.hexdigest()
+        image = find_image(owner_type, owner_id)
+        if image is not None and image.content_hash == content_hash:
+            os.remove(f.name)
+            return None
+
+        store_blob(f.name, content_hash, extension, size)
+
+        # a concurrent upload may have added the image of the owner since it was
+        # looked up, so the row is inserted unless it exists, and updated otherwise
+        values = {"extension": extension, "size": size, "content_hash": content_hash, "mtime": time.time()}
+        inserted = db.session.execute(
+            insert_ignoring_duplicates(Image.__table__).values(owner_type = owner_type, owner_id = owner_id, **values)
+        )
+        released = []
+        if inserted.rowcount == 0:
+            image = Image.query.filter_by(owner_type = owner_type, owner_id = owner_id) \
+                .with_for_update().populate_existing().one()
+            released = [image.content_hash]
+            release_blobs(released)
+            for column, value in values.items():
+                setattr(image, column, value)
+        db.session.commit()
+
+        collect_blobs(released)
+        return None
+
+    def remove_image(image):
+        """
+        Removes an image, and its blob if no other image shares it
+        """
+        released = detach_images(image.owner_type, [image.owner_id])
+        db.session.commit()
+        collect_blobs(released)
+
+    @app.errorhandler(RequestEntityTooLarge)
+    def request_too_large(e):
+        """
+        Rejects requests larger than MAX_CONTENT_LENGTH
+        """
+        return failure_response("request too large", 413)
+
+    @app.cli.command("reindex-images")
+    def reindex_images_command():
+        """
+        Reconciles the image metadata with the files on disk
+        """
+        print("indexed %d images in %d blobs" % reindex_images())
 
     #------------Post route-----------------------------------------------------
     @app.route('/api/images/posts/<int:post_id>/', methods=['POST'])
     def upload_post_image(post_id):
         """
-        Takes uploaded image and store in IMAGE_FOLDER_POST
+        Takes uploaded image and store in IMAGE_FOLDER_BLOBS
         """
         post = Post.query.filter_by(id=post_id).first()
 
@@ -47,68 +493,60 @@ def image_route(app):
 
         if 'image' not in request.files:
             return failure_response("image keyword not provided", 400)
-    
+
         image = request.files['image']
 
         if image is None:
             return failure_response("image not uploaded", 400)
-        
-        if not allowed_file(image.filename):
-            return failure_response("file not supported", 400)
-        
-        check = check_existance('IMAGE_FOLDER_POST', post_id)
-
-        while check is not None:
-            os.remove(check)
-            check = check_existance('IMAGE_FOLDER_POST', post_id)
 
-        folder_path = app.config['IMAGE_FOLDER_POST']
-        filename = os.path.join(folder_path, f"{post_id}.{image.filename.rsplit('.', 1)[1].lower()}")
-        image.save(filename)
+        error = save_image("post", post_id, image)
+        if error is not None:
+            return error
         return success_response("images successfully saved at server", 201)
 
 
     @app.route('/api/images/posts/<int:post_id>/')
     def get_post_image(post_id):
-       """
-       Given post id, gets and returns image from IMAGE_FOLDER_POST
-       """
-       post = Post.query.filter_by(id=post_id).first()
-       
-       if post is None:
+        """
+        Given post id, gets and returns image from IMAGE_FOLDER_BLOBS
+        """
+        post = Post.query.filter_by(id=post_id).first()
+
+        if post is None:
             return failure_response("post not found")
-       
-       check = check_existance('IMAGE_FOLDER_POST', post_id)
-       if check is not None:
-            return send_file(check, mimetype='image/jpeg')
-       return failure_response("file not found")
-    
+
+        image = find_image("post", post_id)
+        if image is None:
+            return failure_response("file not found")
+
+        try:
+            return serve_image(image)
+        except FileNotFoundError:
+            return failure_response("file not found")
+
     @app.route('/api/images/posts/<int:post_id>/', methods=["DELETE"])
     def delete_post_image(post_id):
         """
-        With given post_id, remove the image in IMAGE_FOLDER_POST
+        With given post_id, remove the image in IMAGE_FOLDER_BLOBS
         """
         post = Post.query.filter_by(id=post_id).first()
 
         if post is None:
             return failure_response("post not found")
-        
-        check = check_existance('IMAGE_FOLDER_POST', post_id)
 
-        if check is None: 
+        image = find_image("post", post_id)
+
+        if image is None:
             return failure_response("image not found")
-        
-        while check is not None:
-            os.remove(check)
-            check = check_existance('IMAGE_FOLDER_POST', post_id)
 
+        remove_image(image)
         return success_response("image removed")
-    
+
     #------------------------user route---------------------------------------
     @app.route('/api/images/users/<int:user_id>/', methods=['POST'])
     def upload_user_image(user_id):
         """
-        Takes uploaded image and store in IMAGE_FOLDER_USER
+        Takes uploaded image and store in IMAGE_FOLDER_BLOBS
         """
         user = User.query.filter_by(id=user_id).first()
 
@@ -117,61 +555,53 @@ def image_route(app):
 
         if 'image' not in request.files:
             return failure_response("image keyword not provided", 400)
-    
+
         image = request.files['image']
 
         if image is None:
             return failure_response("image not uploaded", 400)
-        
-        if not allowed_file(image.filename):
-            return failure_response("file not supported", 400)
-        
-        check = check_existance('IMAGE_FOLDER_USER', user_id)
 
-        while check is not None:
-            os.remove(check)
-            check = check_existance('IMAGE_FOLDER_USER', user_id)
-
-        folder_path = app.config['IMAGE_FOLDER_USER']
-        filename = os.path.join(folder_path, f"{user_id}.{image.filename.rsplit('.', 1)[1].lower()}")
-        image.save(filename)
+        error = save_image("user", user_id, image)
+        if error is not None:
+            return error
         return success_response("images successfully saved at server", 201)
 
 
     @app.route('/api/images/users/<int:user_id>/')
     def get_user_image(user_id):
-       """
-       With given post_id, gets and returns the image in IMAGE_FOLDER_USER
-       """
-       user = User.query.filter_by(id=user_id).first()
-       
-       if user is None:
+        """
+        With given post_id, gets and returns the image in IMAGE_FOLDER_BLOBS
+        """
+        user = User.query.filter_by(id=user_id).first()
+
+        if user is None:
             return failure_response("user not found")
-       
-       check = check_existance('IMAGE_FOLDER_USER', user_id)
-       if check is not None:
-            return send_file(check, mimetype='image/jpeg')
-       return failure_response("file not found")
-    
+
+        image = find_image("user", user_id)
+        if image is None:
+            return failure_response("file not found")
+
+        try:
+            return serve_image(image)
+        except FileNotFoundError:
+            return failure_response("file not found")
+
     @app.route('/api/images/users/<int:user_id>/', methods=["DELETE"])
     def delete_user_image(user_id):
         """
-        With given post_id, remove the image in IMAGE_FOLDER_IMAGE
+        With given post_id, remove the image in IMAGE_FOLDER_BLOBS
         """
         user = User.query.filter_by(id=user_id).first()
 
         if user is None:
             return failure_response("user not found")
-        
-        check = check_existance('IMAGE_FOLDER_USER', user_id)
 
-        if check is None: 
+        image = find_image("user", user_id)
+
+        if image is None:
             return failure_response("image not found")
-        
-        while check is not None:
-            os.remove(check)
-            check = check_existance('IMAGE_FOLDER_USER', user_id)
 
+        remove_image(image)
         return success_response("image removed")
-    
+
 
@@ -0,0 +1,212 @@
+import bisect
+import time
+from threading import Lock
+
+from flask import Response, g, request
+
+# upper bounds of the histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+# every metric, in the order they are exposed
+registry = []
+
+
+def format_labels(names, values):
+    """
+    Formats label names and values as {name="value",...}, empty if there are none
+    """
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        pairs.append('%s="%s"' % (name, value))
+    return "{%s}" % ",".join(pairs)
+
+
+class Counter:
+    """
+    Thread-safe counter, one value per combination of label values
+    """
+
+    kind = "counter"
+
+    def __init__(self, name, description, labels = ()):
+        """
+        Initialize a counter and add it to the registry
+        """
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values = {}
+        self.lock = Lock()
+        registry.append(self)
+
+    def inc(self, *label_values, amount = 1):
+        """
+        Adds amount to the value of the given label values
+        """
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        """
+        Returns the (suffix, label names, label values, value) of every sample
+        """
+        with self.lock:
+            return [("", self.labels, label_values, value) for label_values, value in self.values.items()]
+
+
+class Histogram:
+    """
+    Thread-safe histogram counting observations into buckets, one series
+    per combination of label values
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, description, labels = (), buckets = LATENCY_BUCKETS):
+        """
+        Initialize a histogram with the given bucket upper bounds and add it to the registry
+        """
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}
+        self.lock = Lock()
+        registry.append(self)
+
+    def observe(self, value, *label_values):
+        """
+        Records value under the given label values
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                # [observations per bucket with +Inf last, sum, count]
+                series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def samples(self):
+        """
+        Returns the (suffix, label names, label values, value) of every sample,
+        with cumulative bucket counts as the exposition format expects
+        """
+        with self.lock:
+            series = [(label_values, list(counts), total, count) for label_values, (counts, total, count) in self.series.items()]
+
+        samples = []
+        names = self.labels + ("le",)
+        for label_values, counts, total, count in series:
+            cumulative = 0
+            for bound, observations in zip(self.buckets + ("+Inf",), counts):
+                cumulative += observations
+                samples.append(("_bucket", names, label_values + (bound,), cumulative))
+            samples.append(("_sum", self.labels, label_values, total))
+            samples.append(("_count", self.labels, label_values, count))
+        return samples
+
+
+class Collected:
+    """
+    Metric whose samples are read from elsewhere at scrape time, collect
+    returns {label values: value}
+    """
+
+    def __init__(self, name, description, kind, labels, collect):
+        """
+        Initialize a collected metric and add it to the registry
+        """
+        self.name = name
+        self.description = description
+        self.kind = kind
+        self.labels = labels
+        self.collect = collect
+        registry.append(self)
+
+    def samples(self):
+        """
+        Returns the (suffix, label names, label values, value) of every sample
+        """
+        return [("", self.labels, label_values, value) for label_values, value in self.collect().items()]
+
+
+def expose():
+    """
+    Returns every metric of the registry in the Prometheus text format
+    """
+    lines = []
+    for metric in registry:
+        lines.append("# HELP %s %s" % (metric.name, metric.description))
+        lines.append("# TYPE %s %s" % (metric.name, metric.kind))
+        for suffix, names, values, value in metric.samples():
+            lines.append("%s%s%s %s" % (metric.name, suffix, format_labels(names, values), value))
+    return "\n".join(lines) + "\n"
+
+
+# TTLCache instances exposed by name
+caches = {}
+
+
+def register_cache(name, cache):
+    """
+    Exposes the hit and miss counters and the size of a TTLCache under the label cache=name
+    """
+    caches[name] = cache
+
+
+Collected(
+    "cache_hits_total", "Lookups answered by the cache", "counter", ("cache",),
+    lambda: {(name,): cache.stats()["hits"] for name, cache in caches.items()}
+)
+Collected(
+    "cache_misses_total", "Lookups not answered by the cache", "counter", ("cache",),
+    lambda: {(name,): cache.stats()["misses"] for name, cache in caches.items()}
+)
+Collected(
+    "cache_entries", "Entries held by the cache", "gauge", ("cache",),
+    lambda: {(name,): cache.stats()["size"] for name, cache in caches.items()}
+)
+
+requests_total = Counter("http_requests_total", "Requests handled", ("endpoint", "method", "status"))
+request_seconds = Histogram("http_request_duration_seconds", "Time spent handling requests", ("endpoint",))
+response_bytes = Histogram("http_response_size_bytes", "Size of response bodies", ("endpoint",), SIZE_BUCKETS)
+
+
+def metrics_route(app):
+    """
+    Times every request and adds the /metrics endpoint
+
+    Metrics are kept in memory by each process, so every gunicorn worker
+    exposes its own
+    """
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        start = g.pop("request_start", None)
+        if start is None:
+            return response
+
+        # unmatched urls share one label, so that random paths cannot grow the series
+        endpoint = request.endpoint or "unmatched"
+        request_seconds.observe(time.perf_counter() - start, endpoint)
+        requests_total.inc(endpoint, request.method, response.status_code)
+        if response.content_length is not None:
+            response_bytes.observe(response.content_length, endpoint)
+        return response
+
+    @app.route("/metrics")
+    def metrics():
+        """
+        Endpoint exposing the metrics of this process in the Prometheus text format
+        """
+        return Response(expose(), mimetype = "text/plain; version=0.0.4")
@@ -0,0 +1,115 @@
+import base64
+import bisect
+import json
+
+from sqlalchemy import tuple_
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+# rows read at a time when a whole collection is streamed
+STREAM_BATCH_SIZE = 500
+
+
+def parse_limit(value):
+    """
+    Parses the limit query parameter, falling back to DEFAULT_PAGE_SIZE
+    Raises ValueError if the limit is not a positive integer
+    """
+    if value is None:
+        return DEFAULT_PAGE_SIZE
+
+    limit = int(value)
+    if limit <= 0:
+        raise ValueError("limit must be positive")
+    return min(limit, MAX_PAGE_SIZE)
+
+
+def encode_cursor(*values):
+    """
+    Encodes the sort key values of the last row of a page into an opaque cursor
+    """
+    raw = json.dumps(values, default = str).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def decode_cursor(cursor):
+    """
+    Decodes a cursor created by encode_cursor, None if no cursor is given
+    Raises ValueError if the cursor is malformed
+    """
+    if cursor is None:
+        return None
+
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        raise ValueError("malformed cursor")
+
+    if not isinstance(values, list):
+        raise ValueError("malformed cursor")
+    return values
+
+
+def keyset_page(query, key, id_column, cursor, limit):
+    """
+    Returns one page of query ordered by (key, id_column) descending, starting
+    strictly after cursor, which is the (key, id) pair of the previous page's last row
+
+    One extra row is fetched so the caller can tell whether a next page exists
+    Returns (rows, has_more)
+    """
+    if cursor is not None:
+        last_key, last_id = cursor
+        # a row value comparison, which the database resolves as a range of the (key, id) index
+        query = query.filter(tuple_(key, id_column) < tuple_(last_key, last_id))
+
+    rows = query.order_by(key.desc(), id_column.desc()).limit(limit + 1).all()
+    return rows[:limit], len(rows) > limit
+
+
+def parse_fields(value, allowed):
+    """
+    Parses the fields query parameter, names separated by commas, None if not given
+    Raises ValueError if a name is not among allowed
+    """
+    if value is None:
+        return None
+
+    fields = [field for field in value.split(",") if field]
+    if not fields or any(field not in allowed for field in fields):
+        raise ValueError("unknown field")
+    return fields
+
+
+def parse_id_cursor(value):
+    """
+    Decodes a cursor holding the id of the last row of the previous page, None if not given
+    Raises ValueError if the cursor is malformed
+    """
+    cursor = decode_cursor(value)
+    if cursor is None:
+        return None
+
+    try:
+        return int(cursor[0])
+    except (TypeError, IndexError):
+        raise ValueError("malformed cursor")
+
+
+def id_page(query, id_column, after, limit, ids = None, descending = False):
+    """
+    Returns one page of query ordered by id_column, starting strictly after
+    the id after, None for the first page
+
+    ids optionally restricts an increasing page to the given ids, sorted
+    increasingly, which are bound in the query at most limit + 1 at a time
+    Returns (rows, has_more)
+    """
+    if ids is not None:
+        start = 0 if after is None else bisect.bisect_right(ids, after)
+        query = query.filter(id_column.in_(ids[start:start + limit + 1]))
+    elif after is not None:
+        query = query.filter(id_column < after if descending else id_column > after)
+
+    rows = query.order_by(id_column.desc() if descending else id_column).limit(limit + 1).all()
+    return rows[:limit], len(rows) > limit
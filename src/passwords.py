@@ -0,0 +1,111 @@
+import base64
+import hashlib
+import hmac
+import os
+
+from dotenv import load_dotenv
+
+from cache import HostSemaphore
+
+load_dotenv()
+
+# global salt and iterations of the legacy PBKDF2 hashes, stored as raw bytes
+LEGACY_SALT = os.environ.get("PASSWORD_SALT", "")
+LEGACY_ITERATIONS = int(os.environ.get("NUMBER_OF_ITERATIONS", 0))
+
+# cost of new scrypt hashes, hashes made with another cost are upgraded on login
+SCRYPT_N = int(os.environ.get("SCRYPT_N", 2 ** 14))
+SCRYPT_R = int(os.environ.get("SCRYPT_R", 8))
+SCRYPT_P = int(os.environ.get("SCRYPT_P", 1))
+SALT_BYTES = 16
+# hashes computed at once by all the processes of the host
+HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", os.cpu_count() or 1))
+
+hash_slots = HostSemaphore(HASH_WORKERS)
+
+
+def password_hashing(app):
+    """
+    Shares the hashing slots with the other workers of the host through a
+    file in the instance folder
+    """
+    os.makedirs(app.instance_path, exist_ok = True)
+    hash_slots.open(os.path.join(app.instance_path, "password_hash_slots"))
+
+
+def derive(algorithm, params, password, salt):
+    """
+    Derives the key of password with the given algorithm and parameters
+    """
+    if algorithm == "scrypt":
+        n, r, p = params
+        return hashlib.scrypt(password, salt = salt, n = n, r = r, p = p, maxmem = 2 * 128 * n * r * p, dklen = 32)
+    if algorithm == "pbkdf2_sha384":
+        (iterations,) = params
+        return hashlib.pbkdf2_hmac("sha384", password, salt, iterations)
+    raise ValueError("unknown algorithm %s" % algorithm)
+
+
+def run_derive(algorithm, params, password, salt):
+    """
+    Derives a key once one of the HASH_WORKERS hashing slots of the host is
+    free, in the calling thread since hashlib releases the GIL while it
+    hashes, so that the host runs at most that many costly hashes at once
+    """
+    with hash_slots.hold():
+        return derive(algorithm, params, password.encode(), salt)
+
+
+def encode(data):
+    """
+    Base64 encodes bytes into a string
+    """
+    return base64.b64encode(data).decode()
+
+
+def hash_password(password):
+    """
+    Hashes password with scrypt and a random salt
+    Format: scrypt$<n>$<r>$<p>$<base64 salt>$<base64 hash>
+    """
+    salt = os.urandom(SALT_BYTES)
+    params = (SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    key = run_derive("scrypt", params, password, salt)
+    return "$".join(["scrypt"] + [str(param) for param in params] + [encode(salt), encode(key)])
+
+
+def parse(stored):
+    """
+    Splits a stored hash into (algorithm, params, salt, key)
+    Legacy hashes are the raw bytes of PBKDF2-SHA384 with the global salt
+    """
+    if isinstance(stored, bytes):
+        return "pbkdf2_sha384", (LEGACY_ITERATIONS,), LEGACY_SALT.encode(), stored
+
+    algorithm, *params, salt, key = stored.split("$")
+    return algorithm, tuple(int(param) for param in params), base64.b64decode(salt), base64.b64decode(key)
+
+
+def verify_password(password, stored):
+    """
+    Whether password matches the stored hash, in any supported format
+    """
+    try:
+        algorithm, params, salt, key = parse(stored)
+    except ValueError:
+        return False
+
+    if algorithm == "pbkdf2_sha384" and not params[0]:
+        return False
+    return hmac.compare_digest(run_derive(algorithm, params, password, salt), key)
+
+
+def needs_rehash(stored):
+    """
+    Whether the stored hash was made with another algorithm or cost than hash_password uses
+    """
+    try:
+        algorithm, params, _, _ = parse(stored)
+    except ValueError:
+        return True
+    return algorithm != "scrypt" or params != (SCRYPT_N, SCRYPT_R, SCRYPT_P)
@@ -0,0 +1,144 @@
+import heapq
+import logging
+import os
+import time
+from threading import Lock
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from metrics import Collected
+
+logger = logging.getLogger(__name__)
+
+# statements taking longer are logged with their duration
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", 100))
+# requests running more statements are logged, which is how N+1 query patterns show up
+QUERY_COUNT_WARNING = int(os.environ.get("QUERY_COUNT_WARNING", 50))
+SLOWEST_KEPT = 3
+
+
+class QueryStats:
+    """
+    Thread-safe aggregate of the queries run by the requests of each endpoint
+    """
+
+    def __init__(self):
+        """
+        Initialize with no request recorded
+        """
+        self.endpoints = {}
+        self.lock = Lock()
+
+    def record(self, endpoint, queries, seconds):
+        """
+        Adds a request of endpoint that ran queries statements in seconds
+        """
+        with self.lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = {"requests": 0, "queries": 0, "seconds": 0.0, "max_queries": 0}
+            stats["requests"] += 1
+            stats["queries"] += queries
+            stats["seconds"] += seconds
+            stats["max_queries"] = max(stats["max_queries"], queries)
+
+    def snapshot(self):
+        """
+        Returns a copy of the aggregates, keyed by endpoint
+        """
+        with self.lock:
+            return {endpoint: dict(stats) for endpoint, stats in self.endpoints.items()}
+
+
+query_stats = QueryStats()
+
+Collected(
+    "db_queries_total", "Statements run by the requests of each endpoint", "counter", ("endpoint",),
+    lambda: {(endpoint,): stats["queries"] for endpoint, stats in query_stats.snapshot().items()}
+)
+Collected(
+    "db_query_seconds_total", "Time spent in the database by the requests of each endpoint", "counter", ("endpoint",),
+    lambda: {(endpoint,): stats["seconds"] for endpoint, stats in query_stats.snapshot().items()}
+)
+Collected(
+    "db_max_queries", "Most statements run by a single request of each endpoint", "gauge", ("endpoint",),
+    lambda: {(endpoint,): stats["max_queries"] for endpoint, stats in query_stats.snapshot().items()}
+)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def start_query(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def end_query(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    if elapsed * 1000 >= SLOW_QUERY_MS:
+        logger.warning("slow query (%.1f ms): %s", elapsed * 1000, statement)
+
+    if has_request_context() and "db_queries" in g:
+        g.db_queries += 1
+        g.db_time += elapsed
+        if len(g.db_slowest) < SLOWEST_KEPT:
+            heapq.heappush(g.db_slowest, (elapsed, statement))
+        elif elapsed > g.db_slowest[0][0]:
+            heapq.heapreplace(g.db_slowest, (elapsed, statement))
+
+
+@event.listens_for(Engine, "handle_error")
+def fail_query(context):
+    if context.connection is not None and context.connection.info.get("query_start"):
+        context.connection.info["query_start"].pop()
+
+
+def query_instrumentation(app):
+    """
+    Counts the queries and database time of every request
+
+    In debug mode they are sent back as X-DB-* response headers, together
+    with the slowest statements, except for streamed responses whose queries
+    run after the headers are sent. They are always aggregated per endpoint
+    in query_stats, once the body is sent, and requests running more than
+    QUERY_COUNT_WARNING statements are logged
+    """
+
+    @app.before_request
+    def start_counting():
+        g.db_queries = 0
+        g.db_time = 0.0
+        g.db_slowest = []
+
+    def record_queries(counters, endpoint, method, path):
+        """
+        Adds the queries counted for a request to query_stats, logging it if they are too many
+        """
+        query_stats.record(endpoint, counters.db_queries, counters.db_time)
+        if counters.db_queries > QUERY_COUNT_WARNING:
+            logger.warning("%s %s ran %d queries", method, path, counters.db_queries)
+
+    @app.after_request
+    def report_queries(response):
+        if "db_queries" not in g:
+            return response
+
+        if response.is_streamed:
+            # the body, and the queries reading it, only run once this hook returned, so they are
+            # recorded once it is sent, too late for headers
+            counters = g._get_current_object()
+            endpoint, method, path = request.endpoint or "unmatched", request.method, request.path
+            response.call_on_close(lambda: record_queries(counters, endpoint, method, path))
+            return response
+
+        record_queries(g, request.endpoint or "unmatched", request.method, request.path)
+
+        if app.debug:
+            response.headers["X-DB-Queries"] = str(g.db_queries)
+            response.headers["X-DB-Time-Ms"] = "%.2f" % (g.db_time * 1000)
+            response.headers["X-DB-Slowest"] = " | ".join(
+                "%.2f ms %s" % (elapsed * 1000, " ".join(statement.split())[:200])
+                for elapsed, statement in sorted(g.db_slowest, reverse = True)
+            )
+        return response
@@ -0,0 +1,98 @@
+import os
+import random
+import time
+from contextlib import contextmanager
+
+from flask import g, has_app_context, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy.sql.dml import UpdateBase
+
+# bind keys of the read replicas in SQLALCHEMY_BINDS
+REPLICA_PREFIX = "replica"
+STICKY_COOKIE = "db_primary_until"
+
+READ_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+def replica_urls():
+    """
+    Returns the urls of the read replicas, listed in DATABASE_REPLICA_URLS separated by commas
+    """
+    urls = os.environ.get("DATABASE_REPLICA_URLS", "")
+    return [url.strip() for url in urls.split(",") if url.strip()]
+
+
+class RoutingSession(Session):
+    """
+    Session sending the queries of read-only requests to the read replica
+    chosen for the request, and everything else to the primary
+    """
+
+    def get_bind(self, mapper = None, clause = None, bind = None, **kwargs):
+        """
+        Returns the replica engine for reads when the request was routed to a
+        replica, the primary engine otherwise
+        """
+        if bind is None and not self._flushing and not isinstance(clause, UpdateBase) and has_app_context():
+            key = g.get("db_replica")
+            if key is not None:
+                return self._db.engines[key]
+
+        return super().get_bind(mapper = mapper, clause = clause, bind = bind, **kwargs)
+
+
+@contextmanager
+def reading_primary():
+    """
+    Sends the reads of the with block to the primary, for results that must
+    be at least as recent as what was read before, e.g. a version counter
+    """
+    previous = g.get("db_replica")
+    g.db_replica = None
+    try:
+        yield
+    finally:
+        g.db_replica = previous
+
+
+def replica_routing(app):
+    """
+    Routes the reads of GET requests to a random read replica, and every
+    other request to the primary
+
+    After a successful write, the client is sent to the primary for
+    REPLICA_STICKY_SECONDS, longer than the replicas lag behind, so that it
+    reads its own writes
+    """
+    replicas = [key for key in app.config.get("SQLALCHEMY_BINDS", {}) if key.startswith(REPLICA_PREFIX)]
+    sticky_seconds = app.config["REPLICA_STICKY_SECONDS"]
+
+    if not replicas:
+        return
+
+    @app.before_request
+    def choose_database():
+        """
+        Picks the database the queries of this request are sent to
+        """
+        g.db_replica = None
+        if request.method not in READ_METHODS:
+            return
+
+        try:
+            primary_until = float(request.cookies.get(STICKY_COOKIE, 0))
+        except ValueError:
+            primary_until = 0
+        if primary_until < time.time():
+            g.db_replica = random.choice(replicas)
+
+    @app.after_request
+    def stick_to_primary(response):
+        """
+        Keeps the client on the primary for a while after it wrote
+        """
+        if request.method not in READ_METHODS and response.status_code < 400:
+            response.set_cookie(
+                STICKY_COOKIE, str(time.time() + sticky_seconds), max_age = sticky_seconds, httponly = True
+            )
+        return response
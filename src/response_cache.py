@@ -0,0 +1,128 @@
+import hashlib
+import os
+import time
+from functools import wraps
+
+from flask import current_app, make_response, request
+from sqlalchemy import event
+
+from cache import TTLCache, VersionCounters
+from db import TableVersion, db, insert_ignoring_duplicates
+from metrics import register_cache
+from replicas import RoutingSession, reading_primary
+
+# tables whose writes invalidate cached responses
+TABLES = ("feature", "location", "association_features_locations")
+
+# entries are keyed by version, so they only expire to bound memory
+CACHE_TTL = int(os.environ.get("RESPONSE_CACHE_TTL", 3600))
+CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", 1024))
+# seconds before a write handled by another host is seen
+VERSION_POLL_SECONDS = float(os.environ.get("TABLE_VERSION_POLL_SECONDS", 1))
+
+versions = VersionCounters(TABLES)
+responses = TTLCache(CACHE_SIZE)
+register_cache("responses", responses)
+last_poll = 0.0
+
+
+def invalidate(*tables):
+    """
+    Marks the responses built from the given tables as outdated
+    To be called before the write to them is committed, the versions are
+    bumped in the same transaction
+    Returns the new versions of the tables
+    """
+    db.session.execute(insert_ignoring_duplicates(TableVersion.__table__).values(
+        [{"name": table, "version": 0} for table in tables]
+    ))
+    db.session.execute(
+        TableVersion.__table__.update()
+        .where(TableVersion.name.in_(tables))
+        .values(version = TableVersion.version + 1)
+    )
+    bumped = dict(db.session.query(TableVersion.name, TableVersion.version).filter(TableVersion.name.in_(tables)))
+    # only shared with the other workers once committed
+    db.session.info.setdefault("bumped_versions", {}).update(bumped)
+    return [bumped[table] for table in tables]
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def share_bumped_versions(session):
+    """
+    Shares the versions bumped by the committed transaction with the workers of the host
+    """
+    bumped = session.info.pop("bumped_versions", None)
+    if bumped:
+        versions.advance(bumped)
+
+
+@event.listens_for(RoutingSession, "after_rollback")
+def drop_bumped_versions(session):
+    """
+    Forgets the versions bumped by the rolled back transaction
+    """
+    session.info.pop("bumped_versions", None)
+
+
+def table_versions(*tables):
+    """
+    Returns the current versions of the given tables
+
+    They are read from the database at most every VERSION_POLL_SECONDS, for
+    the writes handled by other hosts, otherwise from the counters shared by
+    the workers of the host
+    """
+    global last_poll
+    now = time.monotonic()
+    if now - last_poll >= VERSION_POLL_SECONDS:
+        last_poll = now
+        with reading_primary():
+            versions.advance(dict(db.session.query(TableVersion.name, TableVersion.version)))
+    return tuple(versions.get(table) for table in tables)
+
+
+def cached(*tables):
+    """
+    Caches the successful responses of a GET route built only from the given
+    tables, keyed by path, query string and the versions of those tables
+
+    Cached responses are sent without running the route nor touching the
+    database, with the hash of their body as ETag, so that revalidating
+    clients get 304. Misses are read from the primary, as a lagging replica
+    could return data older than the versions they are cached under
+    """
+    def decorator(route):
+        @wraps(route)
+        def wrapper(*args, **kwargs):
+            # read before running the route, so a concurrent write can only make the entry outdated
+            key = (request.path, request.query_string) + table_versions(*tables)
+            entry = responses.get(key)
+
+            if entry is None:
+                with reading_primary():
+                    response = make_response(route(*args, **kwargs))
+                    if response.status_code != 200:
+                        return response
+                    # read within the block, streamed bodies run their queries now
+                    body = response.get_data()
+
+                entry = (body, response.content_type, hashlib.sha1(body).hexdigest())
+                responses.set(key, entry, CACHE_TTL)
+
+            body, content_type, etag = entry
+            response = current_app.response_class(body, content_type = content_type)
+            response.set_etag(etag)
+            response.cache_control.no_cache = True
+            return response.make_conditional(request)
+        return wrapper
+    return decorator
+
+
+def response_cache(app):
+    """
+    Shares the table versions known to the workers of the host through a
+    file in the instance folder
+    """
+    os.makedirs(app.instance_path, exist_ok = True)
+    versions.open(os.path.join(app.instance_path, "table_versions"))
@@ -0,0 +1,112 @@
+import gzip
+import json
+import os
+import zlib
+
+from flask import Response, request
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# smaller bodies are sent as is, compressing them costs more than it saves
+COMPRESSION_MIN_BYTES = int(os.environ.get("COMPRESSION_MIN_BYTES", 1024))
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+COMPRESSIBLE_TYPES = ("application/json", "text/plain", "text/html")
+
+
+def dumps(body):
+    """
+    Serializes body to JSON bytes, with orjson if it is installed
+    """
+    if orjson is not None:
+        return orjson.dumps(body)
+    return json.dumps(body, separators = (",", ":")).encode()
+
+
+def success_response(body, code = 200):
+    return Response(dumps(body), status = code, mimetype = "application/json")
+
+
+def failure_response(message, code = 404):
+    return Response(dumps({"error": message}), status = code, mimetype = "application/json")
+
+
+def choose_encoding():
+    """
+    Returns the best encoding the client accepts among those available, None if none
+    """
+    encodings = request.accept_encodings
+    if brotli is not None and encodings["br"]:
+        return "br"
+    if encodings["gzip"]:
+        return "gzip"
+    return None
+
+
+def compress_stream(chunks, encoding):
+    """
+    Encodes a streamed body chunk by chunk
+    """
+    if encoding == "br":
+        stream = brotli.Compressor(quality = BROTLI_QUALITY)
+        compress, finish = stream.process, stream.finish
+    else:
+        # wbits 16 + MAX_WBITS writes the gzip header and trailer
+        stream = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        compress, finish = stream.compress, stream.flush
+
+    try:
+        for chunk in chunks:
+            data = compress(chunk.encode() if isinstance(chunk, str) else chunk)
+            if data:
+                yield data
+        yield finish()
+    finally:
+        # lets the wrapped generator release its request context
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+def compression(app):
+    """
+    Compresses the text responses of at least COMPRESSION_MIN_BYTES, and
+    streamed ones, with brotli or gzip as negotiated through Accept-Encoding
+    Files such as images are sent as is
+    """
+
+    @app.after_request
+    def compress_response(response):
+        if response.direct_passthrough or response.status_code != 200 \
+                or "Content-Encoding" in response.headers or response.mimetype not in COMPRESSIBLE_TYPES:
+            return response
+
+        response.vary.add("Accept-Encoding")
+        if not response.is_streamed and response.content_length is not None \
+                and response.content_length < COMPRESSION_MIN_BYTES:
+            return response
+
+        encoding = choose_encoding()
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            response.response = compress_stream(response.response, encoding)
+        elif encoding == "br":
+            response.set_data(brotli.compress(response.get_data(), quality = BROTLI_QUALITY))
+        else:
+            response.set_data(gzip.compress(response.get_data(), GZIP_LEVEL))
+
+        response.headers["Content-Encoding"] = encoding
+        # the encoded body differs byte for byte, but represents the same content
+        etag, weak = response.get_etag()
+        if etag is not None and not weak:
+            response.set_etag(etag, weak = True)
+        return response
@@ -0,0 +1,206 @@
+import heapq
+import logging
+import math
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+METERS_PER_DEGREE = 111320.0
+EARTH_RADIUS = 6371000.0
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """
+    Returns the great-circle distance in meters between two coordinates
+    """
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lon2 - lon1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def parse_coordinates(lat, lon):
+    """
+    Returns lat and lon as floats
+    Raises ValueError unless both are finite numbers, lat within [-90, 90] and lon within [-180, 180]
+    """
+    try:
+        lat, lon = float(lat), float(lon)
+    except (TypeError, ValueError):
+        raise ValueError("invalid coordinates")
+
+    if not (math.isfinite(lat) and math.isfinite(lon) and -90 <= lat <= 90 and -180 <= lon <= 180):
+        raise ValueError("coordinates out of range")
+    return lat, lon
+
+
+class GridIndex:
+    """
+    In-memory spatial index bucketing points into square cells of cell_size degrees
+
+    Queries only visit the cells around the query point, growing ring by ring
+    until no unvisited cell can contain a closer point
+    """
+
+    def __init__(self, cell_size = 0.005):
+        """
+        Initialize an empty index
+        """
+        self.cell_size = cell_size
+        self.points = {}
+        self.cells = {}
+        self.bounds = None
+        self.version = None
+        self.lock = Lock()
+        # held by the thread rebuilding the index, so that concurrent syncs rebuild it once
+        self.rebuild_lock = Lock()
+
+    def cell_of(self, lat, lon):
+        """
+        Returns the (row, col) of the cell containing the given coordinate
+        """
+        return math.floor(lat / self.cell_size), math.floor(lon / self.cell_size)
+
+    def rebuild(self, points, version = None):
+        """
+        Replaces the content of the index with points, an iterable of (id, lat, lon)
+        Points with invalid coordinates are skipped
+        version identifies the state of the database the points were read from
+        The new content is built aside, so queries keep using the old one meanwhile
+        """
+        built = GridIndex(self.cell_size)
+        for point_id, lat, lon in points:
+            try:
+                lat, lon = parse_coordinates(lat, lon)
+            except ValueError:
+                # stored before coordinates were validated, it cannot be placed on the grid
+                logger.warning("point %s not indexed, invalid coordinates %r, %r", point_id, lat, lon)
+                continue
+            built._insert(point_id, lat, lon)
+
+        with self.lock:
+            self.points = built.points
+            self.cells = built.cells
+            self.bounds = built.bounds
+            self.version = version
+
+    def upsert(self, point_id, lat, lon, version = None):
+        """
+        Adds a point, or moves it if it is already indexed
+        With version, the state of the database once this change was counted,
+        it is only applied to an index built from the state just before,
+        which then moves to version. Other indexes are left to be rebuilt
+        """
+        with self.lock:
+            if self._advance(version):
+                self._remove(point_id)
+                self._insert(point_id, lat, lon)
+
+    def remove(self, point_id, version = None):
+        """
+        Removes a point if it is indexed, with version as for upsert
+        """
+        with self.lock:
+            if self._advance(version):
+                self._remove(point_id)
+
+    def _advance(self, version):
+        if version is None:
+            return True
+        if self.version is None or self.version != version - 1:
+            return False
+        self.version = version
+        return True
+
+    def _insert(self, point_id, lat, lon):
+        lat, lon = float(lat), float(lon)
+        row, col = self.cell_of(lat, lon)
+        self.points[point_id] = (lat, lon)
+        self.cells.setdefault((row, col), set()).add(point_id)
+
+        # bounds only ever grow, they just cap how far queries need to look
+        if self.bounds is None:
+            self.bounds = (row, row, col, col)
+        else:
+            min_row, max_row, min_col, max_col = self.bounds
+            self.bounds = (min(min_row, row), max(max_row, row), min(min_col, col), max(max_col, col))
+
+    def _remove(self, point_id):
+        point = self.points.pop(point_id, None)
+        if point is None:
+            return
+
+        cell = self.cell_of(*point)
+        self.cells[cell].discard(point_id)
+        if not self.cells[cell]:
+            del self.cells[cell]
+
+    def nearby(self, lat, lon, radius = None, limit = None):
+        """
+        Returns [(distance, id)] of the points closest to (lat, lon), nearest first
+        At most limit points are returned, and only those within radius meters if given
+        """
+        with self.lock:
+            if not self.cells:
+                return []
+
+            row, col = self.cell_of(lat, lon)
+            min_row, max_row, min_col, max_col = self.bounds
+            max_ring = max(row - min_row, max_row - row, col - min_col, max_col - col, 0)
+
+            # max-heap of (-distance, id) holding the best candidates found so far
+            best = []
+
+            def visit(cells):
+                for cell in cells:
+                    for point_id in self.cells.get(cell, ()):
+                        point_lat, point_lon = self.points[point_id]
+                        distance = haversine(lat, lon, point_lat, point_lon)
+                        if radius is not None and distance > radius:
+                            continue
+                        if limit is None or len(best) < limit:
+                            heapq.heappush(best, (-distance, point_id))
+                        elif distance < -best[0][0]:
+                            heapq.heapreplace(best, (-distance, point_id))
+
+            lat_extent = self.cell_size * METERS_PER_DEGREE
+            for ring in range(max_ring + 1):
+                if 8 * ring > len(self.cells):
+                    # sparse grid, visiting the remaining occupied cells directly is cheaper
+                    visit([
+                        cell for cell in self.cells
+                        if max(abs(cell[0] - row), abs(cell[1] - col)) >= ring
+                    ])
+                    break
+
+                visit(self._ring(row, col, ring))
+
+                # every point outside the visited rings is at least this far away
+                edge_lat = min(abs(lat) + (ring + 1) * self.cell_size, 89.9)
+                bound = ring * min(lat_extent, lat_extent * math.cos(math.radians(edge_lat)))
+                if radius is not None and bound > radius:
+                    break
+                if limit is not None and len(best) == limit and -best[0][0] <= bound:
+                    break
+
+            return sorted((-distance, point_id) for distance, point_id in best)
+
+    def _ring(self, row, col, ring):
+        """
+        Yields the cells at exactly ring cells away from (row, col)
+        """
+        if ring == 0:
+            yield row, col
+            return
+
+        for offset in range(-ring, ring + 1):
+            yield row - ring, col + offset
+            yield row + ring, col + offset
+        for offset in range(-ring + 1, ring):
+            yield row + offset, col - ring
+            yield row + offset, col + ring
+
+
+location_index = GridIndex()
@@ -0,0 +1,164 @@
+import json
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import weather
+from cache import SingleFlight, TTLCache
+
+
+class StubWeatherApi(BaseHTTPRequestHandler):
+    """
+    Weather api answering every request with the status and body set on the
+    server, after its delay, and counting the calls to each endpoint
+    """
+
+    def do_GET(self):
+        server = self.server
+        endpoint = self.path.split("?")[0]
+        with server.lock:
+            server.calls[endpoint] = server.calls.get(endpoint, 0) + 1
+        time.sleep(server.delay)
+
+        status, body = server.responses[endpoint]
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def current_body(temperature):
+    return {"current": {"temp_f": temperature, "condition": {"text": "Sunny"}}}
+
+def astro_body(localtime):
+    return {"location": {"localtime": localtime}, "astronomy": {"astro": {"sunrise": "07:00 AM", "sunset": "06:00 PM"}}}
+
+
+class WeatherCacheTest(unittest.TestCase):
+    """
+    Caching of the weather api responses, against a stub of the api
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), StubWeatherApi)
+        cls.server.lock = threading.Lock()
+        threading.Thread(target = cls.server.serve_forever, daemon = True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.calls = {}
+        self.server.delay = 0
+        self.server.responses = {
+            "/current.json": (200, current_body(50)),
+            "/astronomy.json": (200, astro_body("2026-10-18 12:00"))
+        }
+        # fresh caches and counters for every test
+        for name, value in (
+            ("url", "http://127.0.0.1:%d" % self.server.server_port),
+            ("current_cache", TTLCache(weather.CACHE_SIZE)),
+            ("astro_cache", TTLCache(weather.CACHE_SIZE)),
+            ("in_flight", SingleFlight())
+        ):
+            patcher = mock.patch.object(weather, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.dict(weather.upstream_errors.values, clear = True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def calls(self, endpoint = "/current.json"):
+        return self.server.calls.get(endpoint, 0)
+
+    def test_hit_skips_the_api(self):
+        self.assertEqual(weather.get_weather_at(1, 2)["temp_f"], 50)
+        self.assertEqual(weather.get_weather_at(1, 2)["temp_f"], 50)
+        self.assertEqual(self.calls(), 1)
+        self.assertEqual(weather.current_cache.stats(), {"hits": 1, "misses": 1, "size": 1})
+
+    def test_nearby_positions_share_an_entry(self):
+        weather.get_weather_at(1.001, 2.001)
+        weather.get_weather_at(1.002, 2.002)
+        self.assertEqual(self.calls(), 1)
+
+    def test_entry_expires_after_ttl(self):
+        with mock.patch.object(weather, "CURRENT_TTL", 0.2):
+            weather.get_weather_at(1, 2)
+            self.server.responses["/current.json"] = (200, current_body(60))
+            self.assertEqual(weather.get_weather_at(1, 2)["temp_f"], 50)
+            time.sleep(0.3)
+            self.assertEqual(weather.get_weather_at(1, 2)["temp_f"], 60)
+        self.assertEqual(self.calls(), 2)
+        self.assertEqual(weather.current_cache.stats()["misses"], 2)
+
+    def test_stale_value_served_while_api_fails(self):
+        with mock.patch.object(weather, "CURRENT_TTL", 0.1):
+            weather.get_weather_at(1, 2)
+            time.sleep(0.2)
+            self.server.responses["/current.json"] = (429, {"error": {"message": "rate limited"}})
+            self.assertEqual(weather.get_weather_at(1, 2)["temp_f"], 50)
+        self.assertEqual(weather.upstream_errors.values, {("/current.json",): 1})
+
+    def test_least_recently_used_entry_evicted(self):
+        with mock.patch.object(weather, "current_cache", TTLCache(2)):
+            weather.get_weather_at(1, 1)
+            weather.get_weather_at(2, 2)
+            weather.get_weather_at(1, 1)
+            weather.get_weather_at(3, 3)
+            self.assertEqual(self.calls(), 3)
+            self.assertIn((1.0, 1.0), weather.current_cache)
+            self.assertNotIn((2.0, 2.0), weather.current_cache)
+            weather.get_weather_at(2, 2)
+            self.assertEqual(self.calls(), 4)
+
+    def test_concurrent_misses_share_one_call(self):
+        self.server.delay = 0.2
+        threads = [threading.Thread(target = weather.get_weather_at, args = (1, 2)) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.calls(), 1)
+
+    def test_astro_cached_until_local_midnight(self):
+        self.server.responses["/astronomy.json"] = (200, astro_body("2026-10-18 22:00"))
+        weather.get_astro_at(1, 2)
+        _, ttl = weather.astro_cache.get_with_ttl((1.0, 2.0))
+        self.assertAlmostEqual(ttl, 2 * 3600, delta = 1)
+
+        weather.get_astro_at(1, 2)
+        self.assertEqual(self.calls("/astronomy.json"), 1)
+
+    def test_seconds_until_midnight(self):
+        self.assertEqual(weather.seconds_until_midnight("2026-10-18 00:00"), 24 * 3600)
+        self.assertEqual(weather.seconds_until_midnight("2026-12-31 23:30"), 30 * 60)
+        # never less than a minute, nor unbounded when the local time is unknown
+        self.assertEqual(weather.seconds_until_midnight("2026-10-18 23:59"), 60)
+        self.assertEqual(weather.seconds_until_midnight(None), 3600)
+        self.assertEqual(weather.seconds_until_midnight("18/10/2026"), 3600)
+
+    def test_error_status_counted(self):
+        self.server.responses["/current.json"] = (401, {"error": {"message": "invalid key"}})
+        self.assertIsNone(weather.get_weather_at(1, 2))
+        self.assertEqual(weather.upstream_errors.values, {("/current.json",): 1})
+        self.assertEqual(weather.current_cache.stats()["size"], 0)
+
+    def test_formatted_weather(self):
+        self.assertEqual(json.loads(weather.get_formatted_weather(1, 2)), {
+            "sunrise": "07:00 AM", "sunset": "06:00 PM", "weather": "sunny", "temperature": "50"
+        })
+
+
+if __name__ == "__main__":
+    unittest.main()
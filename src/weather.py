@@ -1,28 +1,153 @@
-import os, json, requests
+import os, json, logging, random, requests, time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from threading import Thread
 from dotenv import load_dotenv
 from flask import request
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from cache import HostSemaphore, SingleFlight, TTLCache
+from db import db, Location
+from metrics import Counter, Histogram, register_cache
 
 load_dotenv()
 url = 'http://api.weatherapi.com/v1'
 API_KEY = os.environ.get("API_KEY")
 
+# coordinates are rounded to this many decimals before lookup, 2 decimals is about 1km
+CACHE_PRECISION = int(os.environ.get("WEATHER_CACHE_PRECISION", 2))
+CURRENT_TTL = int(os.environ.get("WEATHER_CURRENT_TTL", 600))
+CACHE_SIZE = int(os.environ.get("WEATHER_CACHE_SIZE", 4096))
+TIMEOUT = float(os.environ.get("WEATHER_TIMEOUT", 5))
+WORKERS = int(os.environ.get("WEATHER_WORKERS", 16))
+
+# seconds between two refreshes of all locations, 0 disables the prefetcher
+PREFETCH_INTERVAL = int(os.environ.get("WEATHER_PREFETCH_INTERVAL", 0))
+# upstream calls per second the prefetcher allows itself
+PREFETCH_RATE = float(os.environ.get("WEATHER_PREFETCH_RATE", 2))
+PREFETCH_MAX_DELAY = 300
+PREFETCH_JITTER = 0.2
+# seconds between two shares of the prefetched weather with the other workers
+SNAPSHOT_INTERVAL = 10
+
+logger = logging.getLogger(__name__)
+
+current_cache = TTLCache(CACHE_SIZE)
+astro_cache = TTLCache(CACHE_SIZE)
+in_flight = SingleFlight()
+register_cache("weather_current", current_cache)
+register_cache("weather_astro", astro_cache)
+
+upstream_seconds = Histogram("weather_upstream_duration_seconds", "Time spent calling the weather api", ("endpoint",))
+upstream_errors = Counter("weather_upstream_errors_total", "Weather api calls that failed, returned an error status or no json", ("endpoint",))
+executor = ThreadPoolExecutor(max_workers = WORKERS)
+
+# held by the one worker of the host running the prefetcher
+prefetch_lock = HostSemaphore(1)
+
+# keep-alive connections to the weather api are reused across requests
+session = requests.Session()
+adapter = HTTPAdapter(
+    pool_maxsize = WORKERS,
+    max_retries = Retry(total = 2, backoff_factor = 0.2, status_forcelist = (500, 502, 503, 504), allowed_methods = ("GET",))
+)
+session.mount("http://", adapter)
+session.mount("https://", adapter)
+
+
+def bucket(long, lati):
+    """
+    Rounds coordinates to CACHE_PRECISION, so that nearby positions share cache entries
+    """
+    return round(float(long), CACHE_PRECISION), round(float(lati), CACHE_PRECISION)
+
+def seconds_until_midnight(localtime):
+    """
+    Takes in the local time of a location as given by the weather api, returns
+    the number of seconds until the next local midnight, an hour if unknown
+    """
+    try:
+        now = datetime.strptime(localtime, "%Y-%m-%d %H:%M")
+    except (TypeError, ValueError):
+        return 3600
+    midnight = datetime(now.year, now.month, now.day) + timedelta(days = 1)
+    return max(60, int((midnight - now).total_seconds()))
+
+def fetch(endpoint, long, lati):
+    """
+    Queries the given weather api endpoint at a position, returns the json body
+    None if the api cannot be reached, answers with an error status, e.g. when
+    rate limited, or does not answer with json
+    """
+    start = time.perf_counter()
+    try:
+        response = session.get(url+endpoint, params = {"key": API_KEY, "q": str(long)+','+str(lati)}, timeout = TIMEOUT)
+        response.raise_for_status()
+        return response.json()
+    except (requests.RequestException, ValueError):
+        upstream_errors.inc(endpoint)
+        return None
+    finally:
+        upstream_seconds.observe(time.perf_counter() - start, endpoint)
+
+def fetch_weather(long, lati):
+    """
+    Fetches current weather from the api and caches it, returns None on failure
+    """
+    body = fetch('/current.json', long, lati)
+    if body is None:
+        return None
+
+    current = body.get("current")
+    if current is not None:
+        current_cache.set((long, lati), current, CURRENT_TTL)
+    return current
+
+def fetch_astro(long, lati):
+    """
+    Fetches astro info from the api and caches it until the next local midnight, returns None on failure
+    """
+    body = fetch('/astronomy.json', long, lati)
+    if body is None or body.get("astronomy") is None:
+        return None
+
+    astro = body.get("astronomy").get("astro")
+    if astro is not None:
+        localtime = (body.get("location") or {}).get("localtime")
+        astro_cache.set((long, lati), astro, seconds_until_midnight(localtime))
+    return astro
 
 def get_weather_at(long, lati):
     """
     Takes in longtitude and latitude, returns json with temperature info at given location
+    Results are cached for CURRENT_TTL seconds, concurrent misses share one upstream call
+    The last known value is returned if the api cannot be reached
     """
-    request = requests.get(url+'/current.json?key='+API_KEY+'&q='+str(long)+','+str(lati))
-    body = request.json()
-    current = body.get("current")
+    long, lati = bucket(long, lati)
+    current = current_cache.get((long, lati))
+    if current is not None:
+        return current
+
+    current = in_flight.do(("current", long, lati), fetch_weather, long, lati)
+    if current is None:
+        current = current_cache.get_stale((long, lati))
     return current
 
 def get_astro_at(long, lati):
     """
     Takes in longtitude and latitude, returns json with astro info at given location
+    Results are cached until the next local midnight at the location, concurrent misses share one upstream call
+    The last known value is returned if the api cannot be reached
     """
-    request = requests.get(url+'/astronomy.json?key='+API_KEY+'&q='+str(long)+','+str(lati))
-    body = request.json()
-    astro = body.get("astronomy").get("astro")
+    long, lati = bucket(long, lati)
+    astro = astro_cache.get((long, lati))
+    if astro is not None:
+        return astro
+
+    astro = in_flight.do(("astro", long, lati), fetch_astro, long, lati)
+    if astro is None:
+        astro = astro_cache.get_stale((long, lati))
     return astro
 
 def get_formatted_weather(long, lati):
@@ -37,8 +162,10 @@ def get_formatted_weather(long, lati):
     }
     """
     formatted_weather = {}
-    weather = get_weather_at(long, lati)
+    # both lookups run concurrently, so a miss costs one round trip instead of two
+    weather_future = executor.submit(get_weather_at, long, lati)
     astro = get_astro_at(long, lati)
+    weather = weather_future.result()
 
     if weather is None or astro is None:
         return None
@@ -56,7 +183,108 @@ def get_formatted_weather(long, lati):
 
     return json.dumps(formatted_weather)
 
+def save_snapshot(path, positions):
+    """
+    Writes the cached weather and astro info of positions to the file at
+    path, replaced atomically, with the time each entry expires
+    """
+    now = time.time()
+    snapshot = {}
+    for name, cache in (("current", current_cache), ("astro", astro_cache)):
+        entries = []
+        for long, lati in positions:
+            entry = cache.get_with_ttl((long, lati))
+            if entry is not None:
+                entries.append([long, lati, entry[0], now + entry[1]])
+        snapshot[name] = entries
+
+    with open(path + ".tmp", "w") as f:
+        json.dump(snapshot, f)
+    os.replace(path + ".tmp", path)
+
+def load_snapshot(path, loaded):
+    """
+    Fills the caches with the entries of the snapshot at path fresher than
+    their own, if it was written since loaded, the mtime of the last one read
+    Returns the mtime of the snapshot read
+    """
+    try:
+        mtime = os.stat(path).st_mtime
+        if mtime == loaded:
+            return loaded
+        with open(path) as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError):
+        return loaded
+
+    now = time.time()
+    for name, cache in (("current", current_cache), ("astro", astro_cache)):
+        for long, lati, value, expires in snapshot.get(name, []):
+            entry = cache.get_with_ttl((long, lati))
+            if entry is None or entry[1] < expires - now:
+                cache.set((long, lati), value, expires - now)
+    return mtime
+
+def prefetch_weather(app, snapshot_path):
+    """
+    Refreshes the cached weather of every location every PREFETCH_INTERVAL seconds
+
+    Only one worker of the host, the one holding prefetch_lock, calls the api,
+    and shares what it fetched every SNAPSHOT_INTERVAL seconds through the
+    file at snapshot_path, which the other workers load into their caches.
+    When it exits, another worker takes over
+
+    Locations sharing a cache bucket are fetched once. Upstream calls are spaced
+    to stay under PREFETCH_RATE, with jitter, and the spacing backs off
+    exponentially while the api fails or rate limits us, leaving the stale
+    values in the cache to be served meanwhile
+    """
+    min_delay = 1.0 / PREFETCH_RATE
+    delay = min_delay
+    leader = False
+    loaded = None
+
+    while True:
+        leader = leader or prefetch_lock.try_acquire() is not None
+        if not leader:
+            loaded = load_snapshot(snapshot_path, loaded)
+            time.sleep(SNAPSHOT_INTERVAL * random.uniform(1, 1 + PREFETCH_JITTER))
+            continue
+
+        started = time.monotonic()
+        try:
+            with app.app_context():
+                positions = {
+                    bucket(long, lati)
+                    for long, lati in db.session.query(Location.longitude, Location.latitude)
+                }
+
+            saved = time.monotonic()
+            for long, lati in positions:
+                ok = in_flight.do(("current", long, lati), fetch_weather, long, lati) is not None
+                if ok and (long, lati) not in astro_cache:
+                    ok = in_flight.do(("astro", long, lati), fetch_astro, long, lati) is not None
+
+                delay = max(min_delay, delay / 2) if ok else min(PREFETCH_MAX_DELAY, delay * 2)
+                time.sleep(delay * random.uniform(1, 1 + PREFETCH_JITTER))
+
+                if time.monotonic() - saved >= SNAPSHOT_INTERVAL:
+                    save_snapshot(snapshot_path, positions)
+                    saved = time.monotonic()
+            save_snapshot(snapshot_path, positions)
+        except Exception:
+            logger.exception("weather prefetch failed")
+
+        remaining = PREFETCH_INTERVAL - (time.monotonic() - started)
+        time.sleep(max(0, remaining) + random.uniform(0, PREFETCH_JITTER * PREFETCH_INTERVAL))
+
 def weather_route(app):
+    if PREFETCH_INTERVAL > 0:
+        os.makedirs(app.instance_path, exist_ok = True)
+        prefetch_lock.open(os.path.join(app.instance_path, "weather_prefetch.lock"))
+        snapshot_path = os.path.join(app.instance_path, "weather_prefetch.json")
+        Thread(target = prefetch_weather, args = (app, snapshot_path), daemon = True).start()
+
     @app.route('/api/weather/')
     def formatted_weather():
         """
@@ -75,6 +303,24 @@ def weather_route(app):
             return {"error":"incorrect parameters"}, 400
         
         return weather
+
+    @app.route('/api/locations/<int:location_id>/weather/')
+    def location_weather(location_id):
+        """
+        Endpoint for returning formatted weather at a location
+        """
+
+        location = Location.query.filter_by(id = location_id).first()
+
+        if location is None:
+            return {"error":"location not found"}, 404
+
+        weather = get_formatted_weather(location.longitude, location.latitude)
+
+        if weather is None:
+            return {"error":"weather unavailable"}, 503
+
+        return weather
     
 
 
@@ -0,0 +1,4 @@
+from app import create_app
+
+# entry point of production servers, e.g. gunicorn wsgi:app
+app = create_app("production")